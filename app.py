@@ -1,11 +1,15 @@
 import os
+import hmac
 import logging
-import threading
+from functools import wraps
 from datetime import datetime
 from flask import Flask, request, jsonify, render_template, flash, redirect, url_for
 
-# Configure logging
-logging.basicConfig(level=logging.DEBUG)
+import tracing
+from logging_config import setup_logging
+
+# Configure logging (structured, redacted, written from a background thread)
+setup_logging()
 logger = logging.getLogger(__name__)
 
 # Create Flask app
@@ -14,6 +18,17 @@ app.secret_key = os.environ.get("SESSION_SECRET", "dev-secret-key")
 
 # Import webhook handler
 from webhook_handler import handle_webhook_payload
+import review_archive
+from job_scheduler import scheduler
+import circuit_breaker
+from circuit_breaker import UpstreamUnavailable
+
+# Make sure the review archive tables exist before the first query.
+# Failures (e.g. a read-only filesystem) only disable the archive.
+try:
+    review_archive.init_db()
+except Exception as e:
+    logger.error(f"Failed to initialize review archive: {e}")
 
 # Store recent webhook events for display
 import json
@@ -111,7 +126,8 @@ if not recent_events:
 @app.route('/')
 def index():
     """Main dashboard showing recent webhook events"""
-    return render_template('index.html', events=recent_events)
+    return render_template('index.html', events=recent_events,
+                           breakers=circuit_breaker.status())
 
 @app.route('/webhook', methods=['GET', 'POST'], strict_slashes=False)
 @app.route('/webhook/', methods=['GET', 'POST'], strict_slashes=False)
@@ -125,13 +141,23 @@ def webhook():
         })
     
     # Handle POST requests (actual webhooks)
+    # Every webhook gets a trace that follows the job into the worker thread
+    trace = tracing.start_trace('webhook')
+    handed_off = False
     try:
-        # Log the incoming request for debugging
-        logger.debug(f"Webhook received: {request.method} {request.url}")
-        logger.debug(f"Headers: {dict(request.headers)}")
+        # Log the incoming request for debugging (only the headers we need, never auth)
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Webhook received", extra={
+                'method': request.method,
+                'url': request.url,
+                'event_key': request.headers.get('X-Event-Key'),
+                'request_uuid': request.headers.get('X-Request-UUID'),
+                'user_agent': request.headers.get('User-Agent')
+            })
         
         # Get the webhook payload
-        payload = request.get_json()
+        with tracing.span('ingress.parse_payload'):
+            payload = request.get_json()
         
         if not payload:
             logger.error("No JSON payload received")
@@ -142,15 +168,30 @@ def webhook():
         pr_id = str(pr_data.get('id', 'unknown'))
         pr_updated_on = pr_data.get('updated_on', '')
         pr_title = pr_data.get('title', 'No title')
+        repository = payload.get('repository', {}).get('full_name', 'unknown')
+        # Newly opened PRs are reviewed ahead of updates to existing ones
+        event_key = request.headers.get('X-Event-Key')
+        if event_key:
+            is_new_pr = event_key == 'pullrequest:created'
+        else:
+            is_new_pr = bool(pr_data.get('created_on')) and pr_data.get('created_on') == pr_updated_on
+        trace['attributes'].update({
+            'pr_id': pr_id,
+            'repository': repository,
+            'new_pr': is_new_pr
+        })
         
         # Check if this webhook has already been processed (deduplication)
-        if is_webhook_already_processed(pr_id, pr_updated_on):
+        with tracing.span('ingress.deduplicate'):
+            is_duplicate = is_webhook_already_processed(pr_id, pr_updated_on)
+        if is_duplicate:
             logger.info(f"Skipping duplicate webhook retry for PR {pr_id} (same timestamp: {pr_updated_on})")
             return jsonify({
                 'status': 'duplicate_skipped',
                 'message': 'This webhook retry has already been processed',
                 'pr_id': pr_id,
-                'updated_on': pr_updated_on
+                'updated_on': pr_updated_on,
+                'trace_id': trace['trace_id']
             }), 200
         
         logger.info(f"Processing {'updated' if pr_updated_on else 'new'} PR {pr_id}: {pr_title}")
@@ -162,7 +203,8 @@ def webhook():
             'pr_title': pr_title,
             'pr_id': pr_id,
             'status': 'processing',
-            'gemini_response': None
+            'gemini_response': None,
+            'trace_id': trace['trace_id']
         }
         
         # Add to recent events (keep last 10)
@@ -171,45 +213,107 @@ def webhook():
             recent_events.pop()
         
         # Save events to file for persistence
-        save_recent_events(recent_events)
+        with tracing.span('ingress.save_events'):
+            save_recent_events(recent_events)
         
         logger.info(f"Received webhook for PR: {event_info['pr_title']}")
         
         # Respond quickly to prevent timeout, then process asynchronously
-        def process_webhook_async():
-            """Process webhook in background thread"""
-            try:
-                gemini_response = handle_webhook_payload(payload)
-                event_info['status'] = 'success'
-                event_info['gemini_response'] = gemini_response
-                
-                # Mark this webhook as processed to prevent duplicates
-                mark_webhook_processed(pr_id, pr_updated_on)
-                
-                logger.info("Webhook processed successfully")
-            except Exception as e:
-                event_info['status'] = 'error'
-                event_info['error'] = str(e)
-                logger.error(f"Error processing webhook: {e}")
+        def make_job(step, job_trace, failures=0):
+            """Build the background job that runs ``step`` inside ``job_trace``
             
-            # Update the saved events with final status
-            save_recent_events(recent_events)
+            ``failures`` counts earlier failures of this job while its upstream
+            was otherwise healthy (breaker closed).
+            """
+            def process_webhook_async():
+                """Process webhook in background thread"""
+                with tracing.run_in_trace(job_trace):
+                    try:
+                        gemini_response = step()
+                        event_info['status'] = 'success'
+                        event_info['gemini_response'] = gemini_response
+                        event_info.pop('parked_on', None)
+                        
+                        # Mark this webhook as processed to prevent duplicates
+                        with tracing.span('worker.mark_processed'):
+                            mark_webhook_processed(pr_id, pr_updated_on)
+                        
+                        logger.info("Webhook processed successfully")
+                    except UpstreamUnavailable as e:
+                        # With the breaker closed the upstream is healthy, so the failure is
+                        # specific to this job (e.g. a diff too large for Gemini) and counts
+                        # against its replay limit. Outage failures (breaker open) do not.
+                        breaker_closed = circuit_breaker.get_breaker(e.upstream).state == circuit_breaker.CLOSED
+                        job_failures = failures + 1 if breaker_closed else failures
+                        if job_failures > circuit_breaker.MAX_JOB_REPLAYS:
+                            event_info['status'] = 'error'
+                            event_info['error'] = str(e)
+                            event_info.pop('parked_on', None)
+                            job_trace['status'] = 'error'
+                            logger.error(f"Giving up on PR {pr_id} after {job_failures} failures: {e}")
+                        else:
+                            # Park the job instead of failing it; it replays when the upstream recovers
+                            event_info['status'] = 'parked'
+                            event_info['parked_on'] = e.upstream
+                            job_trace['status'] = 'parked'
+                            circuit_breaker.park(e.upstream, make_replay(e.resume or step, job_trace, job_failures),
+                                                 f"PR {pr_id} in {repository}", failures=job_failures,
+                                                 on_drop=make_drop(e.upstream))
+                    except Exception as e:
+                        event_info['status'] = 'error'
+                        event_info['error'] = str(e)
+                        job_trace['status'] = 'error'
+                        logger.error(f"Error processing webhook: {e}")
+                    
+                    # Update the saved events with final status
+                    with tracing.span('worker.save_events'):
+                        save_recent_events(recent_events)
+            return process_webhook_async
         
-        # Start background processing
-        thread = threading.Thread(target=process_webhook_async)
-        thread.daemon = True
-        thread.start()
+        def make_replay(step, parked_trace, failures):
+            """Resubmit a parked job to the scheduler under a new trace"""
+            def replay():
+                attributes = {k: v for k, v in parked_trace['attributes'].items() if k != 'queue_wait_ms'}
+                attributes['replay_of'] = parked_trace['trace_id']
+                replay_trace = tracing.start_trace('webhook.replay', **attributes)
+                tracing.detach()
+                event_info['status'] = 'processing'
+                event_info['trace_id'] = replay_trace['trace_id']
+                scheduler.submit(repository, make_job(step, replay_trace, failures),
+                                 is_new_pr=is_new_pr, trace=replay_trace)
+            return replay
+        
+        def make_drop(upstream):
+            """Mark the event as failed if its parked job is dropped (too many parked jobs)"""
+            def on_drop():
+                event_info['status'] = 'error'
+                event_info['error'] = f"Dropped while waiting for {upstream} to recover (too many parked jobs)"
+                event_info.pop('parked_on', None)
+                save_recent_events(recent_events)
+            return on_drop
+        
+        # Queue for background processing (fair-share across repositories)
+        tracing.detach()
+        scheduler.submit(repository, make_job(lambda: handle_webhook_payload(payload), trace),
+                         is_new_pr=is_new_pr, trace=trace)
+        handed_off = True
         
         # Return immediately to prevent webhook timeout
         return jsonify({
             'status': 'received',
-            'message': 'Webhook received and processing started',
-            'pr_id': pr_id
+            'message': 'Webhook received and queued for processing',
+            'pr_id': pr_id,
+            'trace_id': trace['trace_id']
         }), 200
         
     except Exception as e:
         logger.error(f"Webhook error: {e}")
+        trace['status'] = 'error'
         return jsonify({'error': str(e)}), 500
+    finally:
+        # Traces handed to the worker thread are finished there
+        if not handed_off:
+            tracing.finish_trace(trace)
 
 @app.route('/test')
 def test():
@@ -233,9 +337,20 @@ def health():
             'message': f'Missing environment variables: {", ".join(missing_vars)}'
         }), 500
     
+    # Report upstream outages without failing the health check itself
+    breakers = circuit_breaker.status()
+    open_breakers = [name for name, breaker in breakers.items() if breaker['state'] != circuit_breaker.CLOSED]
+    if open_breakers:
+        return jsonify({
+            'status': 'degraded',
+            'message': f'Upstream unavailable, jobs are parked: {", ".join(open_breakers)}',
+            'circuit_breakers': breakers
+        })
+    
     return jsonify({
         'status': 'healthy',
-        'message': 'All required environment variables are set'
+        'message': 'All required environment variables are set',
+        'circuit_breakers': breakers
     })
 
 @app.route('/gemini-responses')
@@ -252,6 +367,132 @@ def gemini_responses():
             })
     return jsonify(responses)
 
+@app.route('/scheduler')
+def scheduler_stats():
+    """Per-repository queue depth, wait times, concurrency and token quota usage"""
+    return jsonify(scheduler.stats())
+
+def require_admin_token(view):
+    """Allow the request only with the ADMIN_API_TOKEN shared secret
+    
+    Send it as "Authorization: Bearer <token>" or "X-Admin-Token: <token>".
+    Routes using this are disabled entirely while ADMIN_API_TOKEN is unset.
+    """
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        expected = os.environ.get('ADMIN_API_TOKEN')
+        if not expected:
+            return jsonify({'error': 'This endpoint is disabled (ADMIN_API_TOKEN not set)'}), 403
+        provided = request.headers.get('X-Admin-Token', '')
+        auth_header = request.headers.get('Authorization', '')
+        if auth_header.startswith('Bearer '):
+            provided = auth_header[len('Bearer '):]
+        if not hmac.compare_digest(provided.encode(), expected.encode()):
+            return jsonify({'error': 'Unauthorized'}), 401
+        return view(*args, **kwargs)
+    return wrapper
+
+def archive_unavailable():
+    """Response for archive endpoints when the archive database could not be opened"""
+    return jsonify({'error': 'Review archive is unavailable (is REVIEW_ARCHIVE_DB writable?)'}), 503
+
+@app.route('/archive/reviews')
+def archive_reviews():
+    """Query archived reviews
+    
+    Filters: repository, pr_id, author, status, since, until (ISO 8601 dates),
+    security=1|0, limit, offset. Example:
+    /archive/reviews?repository=team/plugin&security=1&since=2026-09-01&until=2026-10-01
+    """
+    if not review_archive.is_available():
+        return archive_unavailable()
+    security = request.args.get('security')
+    try:
+        reviews = review_archive.query_reviews(
+            repository=request.args.get('repository'),
+            pr_id=request.args.get('pr_id'),
+            author=request.args.get('author'),
+            status=request.args.get('status'),
+            since=request.args.get('since'),
+            until=request.args.get('until'),
+            security_findings=None if security is None else security in ('1', 'true', 'yes'),
+            limit=request.args.get('limit', 50, type=int),
+            offset=request.args.get('offset', 0, type=int)
+        )
+    except Exception as e:
+        logger.error(f"Archive query failed: {e}")
+        return jsonify({'error': str(e)}), 500
+    return jsonify(reviews)
+
+@app.route('/archive/reviews/<int:review_id>')
+@require_admin_token
+def archive_review_detail(review_id):
+    """Return one archived review with its diff, prompt template and review text"""
+    if not review_archive.is_available():
+        return archive_unavailable()
+    review = review_archive.get_review(review_id)
+    if not review:
+        return jsonify({'error': 'Review not found'}), 404
+    return jsonify(review)
+
+@app.route('/archive/stats')
+def archive_stats():
+    """Archive size, compression and retention summary"""
+    if not review_archive.is_available():
+        return archive_unavailable()
+    return jsonify(review_archive.archive_stats())
+
+@app.route('/archive/retention', methods=['POST'])
+@require_admin_token
+def archive_retention():
+    """Run the retention policy now (optionally with {"retention_days": N})"""
+    if not review_archive.is_available():
+        return archive_unavailable()
+    settings = request.get_json(silent=True) or {}
+    retention_days = settings.get('retention_days')
+    try:
+        retention_days = None if retention_days is None else int(retention_days)
+    except (TypeError, ValueError):
+        return jsonify({'error': 'retention_days must be an integer'}), 400
+    review_archive.schedule_retention(retention_days)
+    return jsonify({'status': 'scheduled'}), 202
+
+@app.route('/debug/traces')
+@require_admin_token
+def debug_traces():
+    """Return the slowest recent webhook traces"""
+    limit = request.args.get('limit', 10, type=int)
+    include_profile = request.args.get('profile', '1') != '0'
+    return jsonify(tracing.get_slowest_traces(limit, include_profile))
+
+@app.route('/debug/profiling', methods=['GET', 'POST'])
+@require_admin_token
+def debug_profiling():
+    """Show or change sampled cProfile profiling of worker jobs
+    
+    POST a JSON body such as {"enabled": true, "sample_rate": 0.25} to turn
+    profiling on. Profiled traces include a ``profile`` section.
+    """
+    if request.method == 'POST':
+        settings = request.get_json(silent=True) or {}
+        try:
+            config = tracing.set_profiling(
+                enabled=settings.get('enabled'),
+                sample_rate=settings.get('sample_rate'),
+                top_n=settings.get('top_n')
+            )
+        except (TypeError, ValueError) as e:
+            return jsonify({'error': f'Invalid profiling settings: {e}'}), 400
+        logger.info(f"Profiling settings updated: {config}")
+    else:
+        config = tracing.get_profiling_config()
+    
+    profiled = [t for t in tracing.get_slowest_traces(limit=tracing.MAX_RECENT_TRACES) if t.get('profile')]
+    return jsonify({
+        'profiling': config,
+        'slowest_profiled_traces': profiled[:request.args.get('limit', 5, type=int)]
+    })
+
 @app.route('/test-gemini')
 def test_gemini():
     """Test Gemini AI with a sample WordPress code diff"""
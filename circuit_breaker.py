@@ -0,0 +1,272 @@
+import time
+import logging
+import threading
+from collections import deque
+
+from env_config import env_float, env_int, env_number
+
+logger = logging.getLogger(__name__)
+
+# --- Configuration ---
+# Defaults for every upstream; override per upstream with e.g. GEMINI_BREAKER_FAILURE_THRESHOLD
+BREAKER_FAILURE_THRESHOLD = env_int("BREAKER_FAILURE_THRESHOLD", 5)
+BREAKER_RECOVERY_SECONDS = env_float("BREAKER_RECOVERY_SECONDS", 60.0)
+BREAKER_HALF_OPEN_MAX_CALLS = env_int("BREAKER_HALF_OPEN_MAX_CALLS", 1)
+BREAKER_SUCCESS_THRESHOLD = env_int("BREAKER_SUCCESS_THRESHOLD", 1)
+# How often parked jobs are checked for replay
+REPLAY_INTERVAL_SECONDS = env_float("REPLAY_INTERVAL_SECONDS", 5.0)
+# Oldest parked jobs are dropped beyond this many per upstream
+MAX_PARKED_JOBS = env_int("MAX_PARKED_JOBS", 500)
+# A job that keeps failing while its upstream is otherwise healthy (breaker closed)
+# is replayed at most this many times, waiting REPLAY_BACKOFF_SECONDS * 2^n between tries
+MAX_JOB_REPLAYS = env_int("MAX_JOB_REPLAYS", 3)
+REPLAY_BACKOFF_SECONDS = env_float("REPLAY_BACKOFF_SECONDS", 30.0)
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+
+class UpstreamUnavailable(Exception):
+    """Raised when an upstream is down or its circuit breaker is open
+
+    ``resume`` optionally holds a callable that continues the job from the
+    failed stage, so completed work (e.g. a Gemini review) is not repeated.
+    """
+
+    def __init__(self, upstream: str, message: str, resume=None):
+        super().__init__(message)
+        self.upstream = upstream
+        self.resume = resume
+
+
+def _setting(upstream: str, name: str, default, cast):
+    return env_number(f"{upstream.upper()}_BREAKER_{name}", default, cast)
+
+
+class CircuitBreaker:
+    """Closed/open/half-open circuit breaker for one upstream service
+
+    Closed: calls go through; ``failure_threshold`` consecutive failures open it.
+    Open: calls are rejected until ``recovery_timeout`` seconds have passed.
+    Half-open: up to ``half_open_max_calls`` trial calls are allowed;
+    ``success_threshold`` successes close it, any failure opens it again.
+    """
+
+    def __init__(self, name: str, failure_threshold: int = None, recovery_timeout: float = None,
+                 half_open_max_calls: int = None, success_threshold: int = None):
+        self.name = name
+        self.failure_threshold = failure_threshold or _setting(name, 'FAILURE_THRESHOLD', BREAKER_FAILURE_THRESHOLD, int)
+        self.recovery_timeout = recovery_timeout or _setting(name, 'RECOVERY_SECONDS', BREAKER_RECOVERY_SECONDS, float)
+        self.half_open_max_calls = half_open_max_calls or _setting(name, 'HALF_OPEN_MAX_CALLS', BREAKER_HALF_OPEN_MAX_CALLS, int)
+        self.success_threshold = success_threshold or _setting(name, 'SUCCESS_THRESHOLD', BREAKER_SUCCESS_THRESHOLD, int)
+        self._lock = threading.Lock()
+        self._state = CLOSED
+        self._failures = 0
+        self._successes = 0
+        self._trial_calls = 0
+        self._opened_at = None
+        self._last_failure = None
+        self._last_error = None
+        self._total_failures = 0
+        self._rejected = 0
+
+    @property
+    def state(self) -> str:
+        with self._lock:
+            return self._state
+
+    def allow_request(self) -> bool:
+        """Return True if a call may be made now; every allowed call must record its outcome"""
+        with self._lock:
+            if self._state == OPEN:
+                if time.time() - self._opened_at < self.recovery_timeout:
+                    self._rejected += 1
+                    return False
+                self._transition(HALF_OPEN)
+            if self._state == HALF_OPEN:
+                if self._trial_calls >= self.half_open_max_calls:
+                    self._rejected += 1
+                    return False
+                self._trial_calls += 1
+            return True
+
+    def check(self, resume=None):
+        """Raise UpstreamUnavailable unless a call may be made now"""
+        if not self.allow_request():
+            raise UpstreamUnavailable(self.name, f"Circuit breaker for {self.name} is open", resume)
+
+    def record_success(self):
+        """The upstream answered (including client errors such as 4xx)"""
+        with self._lock:
+            if self._state == HALF_OPEN:
+                self._trial_calls = max(self._trial_calls - 1, 0)
+                self._successes += 1
+                if self._successes >= self.success_threshold:
+                    self._transition(CLOSED)
+            else:
+                self._failures = 0
+
+    def record_failure(self, error=None):
+        """The upstream failed in a way that suggests an outage"""
+        with self._lock:
+            self._total_failures += 1
+            self._last_failure = time.time()
+            self._last_error = str(error)[:200] if error else None
+            if self._state == HALF_OPEN:
+                self._trial_calls = max(self._trial_calls - 1, 0)
+                self._transition(OPEN)
+            elif self._state == CLOSED:
+                self._failures += 1
+                if self._failures >= self.failure_threshold:
+                    self._transition(OPEN)
+
+    def ready_for_trial(self) -> bool:
+        """True if an open breaker would admit a trial call now"""
+        with self._lock:
+            if self._state == OPEN:
+                return time.time() - self._opened_at >= self.recovery_timeout
+            return self._state == HALF_OPEN and self._trial_calls < self.half_open_max_calls
+
+    def _transition(self, state):
+        # Caller holds the lock
+        if state == self._state:
+            return
+        logger.warning(f"Circuit breaker for {self.name} changed from {self._state} to {state}")
+        self._state = state
+        self._failures = 0
+        self._successes = 0
+        self._trial_calls = 0
+        self._opened_at = time.time() if state == OPEN else None
+
+    def status(self) -> dict:
+        with self._lock:
+            retry_in = None
+            if self._state == OPEN:
+                retry_in = max(round(self.recovery_timeout - (time.time() - self._opened_at), 1), 0)
+            return {
+                'state': self._state,
+                'consecutive_failures': self._failures,
+                'failure_threshold': self.failure_threshold,
+                'recovery_timeout': self.recovery_timeout,
+                'retry_in_seconds': retry_in,
+                'total_failures': self._total_failures,
+                'rejected_calls': self._rejected,
+                'last_failure': time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(self._last_failure)) if self._last_failure else None,
+                'last_error': self._last_error,
+                'parked_jobs': len(_parked.get(self.name, ()))
+            }
+
+
+breakers = {
+    'bitbucket': CircuitBreaker('bitbucket'),
+    'gemini': CircuitBreaker('gemini')
+}
+
+
+def get_breaker(name: str) -> CircuitBreaker:
+    return breakers[name]
+
+
+def status() -> dict:
+    """State of every circuit breaker, keyed by upstream"""
+    return {name: breaker.status() for name, breaker in breakers.items()}
+
+
+# --- Parked jobs ---
+
+_parked = {name: deque() for name in breakers}
+_parked_lock = threading.Lock()
+_last_trial_release = {}
+_replayer_thread = None
+
+
+def replay_backoff(failures: int) -> float:
+    """Seconds to wait before replaying a job that has failed ``failures`` times on its own"""
+    if failures <= 0:
+        return 0.0
+    return REPLAY_BACKOFF_SECONDS * 2 ** (failures - 1)
+
+
+def park(upstream: str, replay, description: str = '', failures: int = 0, on_drop=None):
+    """Hold a job until ``upstream`` recovers; ``replay`` is called to resubmit it
+
+    ``failures`` counts the job's own failures while the breaker was closed;
+    the job is not released before its backoff for that count has passed.
+    ``on_drop`` is called if the job is later dropped because too many jobs
+    are parked, so the caller can mark it as failed.
+    """
+    now = time.time()
+    dropped = None
+    with _parked_lock:
+        jobs = _parked.setdefault(upstream, deque())
+        if len(jobs) >= MAX_PARKED_JOBS:
+            dropped = jobs.popleft()
+        jobs.append({
+            'replay': replay,
+            'description': description,
+            'parked_at': now,
+            'failures': failures,
+            'not_before': now + replay_backoff(failures),
+            'on_drop': on_drop
+        })
+    logger.warning(f"Parked job on {upstream} ({failures} failed replays): {description}")
+    if dropped is not None:
+        logger.error(f"Too many parked {upstream} jobs, dropping oldest: {dropped['description']}")
+        if dropped['on_drop'] is not None:
+            try:
+                dropped['on_drop']()
+            except Exception as e:
+                logger.error(f"Failed to mark dropped job as failed: {e}")
+    _ensure_replayer()
+
+
+def _jobs_to_release(upstream: str, breaker: CircuitBreaker, now: float = None) -> list:
+    now = time.time() if now is None else now
+    with _parked_lock:
+        jobs = _parked.get(upstream)
+        if not jobs:
+            return []
+        ready = [job for job in jobs if job['not_before'] <= now]
+        if not ready:
+            return []
+        if breaker.state == CLOSED:
+            released = ready
+        # Open or half-open: release a single job as the trial call, at most once per recovery period
+        elif breaker.ready_for_trial() and now - _last_trial_release.get(upstream, 0) >= breaker.recovery_timeout:
+            _last_trial_release[upstream] = now
+            released = ready[:1]
+        else:
+            return []
+        for job in released:
+            jobs.remove(job)
+        return released
+
+
+def replay_ready_jobs():
+    """Resubmit parked jobs whose upstream has recovered (or may be probed)"""
+    for upstream, breaker in breakers.items():
+        for job in _jobs_to_release(upstream, breaker):
+            waited = round(time.time() - job['parked_at'], 1)
+            logger.info(f"Replaying job parked on {upstream} for {waited}s: {job['description']}")
+            try:
+                job['replay']()
+            except Exception as e:
+                logger.error(f"Failed to replay parked job: {e}")
+
+
+def _replay_loop():
+    while True:
+        time.sleep(REPLAY_INTERVAL_SECONDS)
+        try:
+            replay_ready_jobs()
+        except Exception as e:
+            logger.error(f"Parked job replay failed: {e}")
+
+
+def _ensure_replayer():
+    global _replayer_thread
+    with _parked_lock:
+        if _replayer_thread is None or not _replayer_thread.is_alive():
+            _replayer_thread = threading.Thread(target=_replay_loop, name='parked-job-replayer', daemon=True)
+            _replayer_thread.start()
@@ -0,0 +1,27 @@
+import os
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+def env_number(name: str, default, cast=int):
+    """Read a numeric setting, falling back to ``default`` with a warning if it is invalid
+
+    A typo in a tuning variable must not stop the service from booting.
+    """
+    value = os.environ.get(name)
+    if value is None or not value.strip():
+        return default
+    try:
+        return cast(value.strip())
+    except ValueError:
+        logger.warning(f"Invalid value {value!r} for {name}, using {default}")
+        return default
+
+
+def env_int(name: str, default: int) -> int:
+    return env_number(name, default, int)
+
+
+def env_float(name: str, default: float) -> float:
+    return env_number(name, default, float)
@@ -0,0 +1,250 @@
+import os
+import time
+import heapq
+import logging
+import itertools
+import threading
+from collections import deque
+
+from env_config import env_float, env_int
+
+logger = logging.getLogger(__name__)
+
+# --- Configuration ---
+# Size of the shared review worker pool
+WORKER_COUNT = env_int("WORKER_COUNT", 4)
+# Defaults per repository; override per repo with "workspace/repo=value,..." lists
+DEFAULT_REPO_WEIGHT = env_float("REPO_DEFAULT_WEIGHT", 1.0)
+DEFAULT_REPO_CONCURRENCY = env_int("REPO_DEFAULT_CONCURRENCY", 2)
+# Gemini tokens a repository may use per rolling hour (0 = unlimited)
+DEFAULT_REPO_TOKEN_QUOTA = env_int("REPO_DEFAULT_TOKEN_QUOTA", 0)
+REPO_WEIGHTS = os.environ.get("REPO_WEIGHTS", "")
+REPO_CONCURRENCY = os.environ.get("REPO_CONCURRENCY", "")
+REPO_TOKEN_QUOTAS = os.environ.get("REPO_TOKEN_QUOTAS", "")
+
+TOKEN_QUOTA_WINDOW_SECONDS = 3600
+# Idle workers re-check token quotas at least this often
+POLL_INTERVAL_SECONDS = 5
+WAIT_SAMPLES = 200
+
+# Lower runs first within a repository queue
+PRIORITY_NEW_PR = 0
+PRIORITY_UPDATE = 1
+# Virtual-time credit (in jobs) for a repository whose next job is a new PR.
+# Kept below 1 so the boost can never let one repository jump a whole turn.
+NEW_PR_VTIME_CREDIT = 0.5
+
+
+def _parse_overrides(spec: str, cast) -> dict:
+    overrides = {}
+    for item in spec.split(','):
+        if '=' not in item:
+            continue
+        name, value = item.rsplit('=', 1)
+        try:
+            overrides[name.strip()] = cast(value.strip())
+        except ValueError:
+            logger.warning(f"Ignoring invalid scheduler override: {item}")
+    return overrides
+
+
+def _percentile(values, fraction):
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(int(len(ordered) * fraction), len(ordered) - 1)]
+
+
+class FairScheduler:
+    """Per-repository job queues served by a shared worker pool
+
+    Repositories are picked by weighted fair queueing: each dispatch advances
+    the repository's virtual time by 1 / weight and the eligible repository
+    with the lowest virtual time runs next. A repository is eligible while it
+    is below its concurrency cap and its hourly Gemini token quota. Within a
+    repository, jobs for newly opened PRs are served before updates; across
+    repositories they only get a bounded virtual-time credit, so a repository
+    opening many PRs cannot starve the others.
+    """
+
+    def __init__(self, workers=WORKER_COUNT, weights=None, concurrency=None, token_quotas=None):
+        self.workers = max(int(workers), 1)
+        self.weights = weights if weights is not None else _parse_overrides(REPO_WEIGHTS, float)
+        self.concurrency = concurrency if concurrency is not None else _parse_overrides(REPO_CONCURRENCY, int)
+        self.token_quotas = token_quotas if token_quotas is not None else _parse_overrides(REPO_TOKEN_QUOTAS, int)
+        self._cond = threading.Condition()
+        self._repos = {}
+        self._seq = itertools.count()
+        self._vclock = 0.0
+        self._threads = []
+
+    # --- Configuration lookups ---
+
+    def weight(self, repository):
+        return max(self.weights.get(repository, DEFAULT_REPO_WEIGHT), 0.01)
+
+    def max_concurrency(self, repository):
+        return max(self.concurrency.get(repository, DEFAULT_REPO_CONCURRENCY), 1)
+
+    def token_quota(self, repository):
+        return self.token_quotas.get(repository, DEFAULT_REPO_TOKEN_QUOTA)
+
+    # --- Public API ---
+
+    def start(self):
+        """Start the worker pool (idempotent)"""
+        with self._cond:
+            if self._threads:
+                return
+            for i in range(self.workers):
+                thread = threading.Thread(target=self._worker_loop, name=f'review-worker-{i + 1}', daemon=True)
+                thread.start()
+                self._threads.append(thread)
+
+    def submit(self, repository: str, func, is_new_pr: bool = False, trace: dict = None) -> dict:
+        """Queue ``func`` to run on behalf of ``repository``"""
+        self.start()
+        job = {
+            'repository': repository or 'unknown',
+            'func': func,
+            'is_new_pr': is_new_pr,
+            'trace': trace,
+            'enqueued_at': time.time()
+        }
+        priority = PRIORITY_NEW_PR if is_new_pr else PRIORITY_UPDATE
+        with self._cond:
+            state = self._repo_state(job['repository'])
+            if not state['queue'] and not state['running']:
+                # Idle repositories rejoin at the current virtual time instead of
+                # spending credit they built up while idle
+                state['vtime'] = max(state['vtime'], self._vclock)
+            heapq.heappush(state['queue'], (priority, next(self._seq), job))
+            state['submitted'] += 1
+            self._cond.notify()
+        return job
+
+    def record_token_usage(self, repository: str, tokens):
+        """Charge Gemini tokens against a repository's hourly quota"""
+        if not tokens:
+            return
+        with self._cond:
+            state = self._repo_state(repository or 'unknown')
+            state['token_usage'].append((time.time(), int(tokens)))
+            state['tokens_total'] += int(tokens)
+
+    def stats(self) -> dict:
+        """Per-repository queue depth, wait times and quota usage"""
+        now = time.time()
+        with self._cond:
+            repos = {}
+            for name, state in self._repos.items():
+                waits = list(state['waits'])
+                oldest = min((job['enqueued_at'] for _, _, job in state['queue']), default=None)
+                quota = self.token_quota(name)
+                repos[name] = {
+                    'queued': len(state['queue']),
+                    'running': state['running'],
+                    'weight': self.weight(name),
+                    'max_concurrency': self.max_concurrency(name),
+                    'token_quota_per_hour': quota or None,
+                    'tokens_last_hour': self._tokens_in_window(state, now),
+                    'tokens_total': state['tokens_total'],
+                    'submitted': state['submitted'],
+                    'completed': state['completed'],
+                    'failed': state['failed'],
+                    'oldest_queued_seconds': round(now - oldest, 1) if oldest else None,
+                    'wait_ms_avg': round(sum(waits) / len(waits), 1) if waits else None,
+                    'wait_ms_p95': _percentile(waits, 0.95),
+                    'wait_ms_max': max(waits) if waits else None
+                }
+            return {
+                'workers': self.workers,
+                'busy_workers': sum(state['running'] for state in self._repos.values()),
+                'queued': sum(len(state['queue']) for state in self._repos.values()),
+                'repositories': repos
+            }
+
+    # --- Internals ---
+
+    def _repo_state(self, repository):
+        state = self._repos.get(repository)
+        if state is None:
+            state = {
+                'queue': [],
+                'running': 0,
+                'vtime': self._vclock,
+                'token_usage': deque(),
+                'tokens_total': 0,
+                'waits': deque(maxlen=WAIT_SAMPLES),
+                'submitted': 0,
+                'completed': 0,
+                'failed': 0
+            }
+            self._repos[repository] = state
+        return state
+
+    def _tokens_in_window(self, state, now):
+        usage = state['token_usage']
+        while usage and now - usage[0][0] > TOKEN_QUOTA_WINDOW_SECONDS:
+            usage.popleft()
+        return sum(tokens for _, tokens in usage)
+
+    def _pick(self):
+        """Pop the next job to run, or None if nothing is eligible (caller holds the lock)"""
+        now = time.time()
+        best = None
+        for name, state in self._repos.items():
+            if not state['queue'] or state['running'] >= self.max_concurrency(name):
+                continue
+            quota = self.token_quota(name)
+            if quota and self._tokens_in_window(state, now) >= quota:
+                continue
+            key = state['vtime']
+            if state['queue'][0][0] == PRIORITY_NEW_PR:
+                key -= NEW_PR_VTIME_CREDIT / self.weight(name)
+            if best is None or key < best[0]:
+                best = (key, name, state)
+
+        if best is None:
+            return None
+
+        _, name, state = best
+        _, _, job = heapq.heappop(state['queue'])
+        state['running'] += 1
+        self._vclock = state['vtime']
+        state['vtime'] += 1.0 / self.weight(name)
+        return job, state
+
+    def _worker_loop(self):
+        while True:
+            with self._cond:
+                picked = self._pick()
+                while picked is None:
+                    self._cond.wait(timeout=POLL_INTERVAL_SECONDS)
+                    picked = self._pick()
+                job, state = picked
+                wait_ms = round((time.time() - job['enqueued_at']) * 1000, 1)
+                state['waits'].append(wait_ms)
+
+            if job['trace'] is not None:
+                job['trace']['attributes']['queue_wait_ms'] = wait_ms
+            logger.info(f"Dispatching job for {job['repository']} after {wait_ms} ms in queue"
+                        f"{' (new PR)' if job['is_new_pr'] else ''}")
+
+            failed = False
+            try:
+                job['func']()
+            except Exception as e:
+                failed = True
+                logger.error(f"Scheduled job for {job['repository']} failed: {e}")
+            finally:
+                with self._cond:
+                    state['running'] -= 1
+                    state['completed'] += 1
+                    if failed:
+                        state['failed'] += 1
+                    self._cond.notify_all()
+
+
+# Shared scheduler used by the webhook endpoint
+scheduler = FairScheduler()
@@ -0,0 +1,384 @@
+import os
+import re
+import time
+import zlib
+import queue
+import atexit
+import sqlite3
+import hashlib
+import logging
+import threading
+from datetime import datetime, timedelta, timezone
+
+from env_config import env_int
+
+logger = logging.getLogger(__name__)
+
+# --- Configuration ---
+# Must be on a writable filesystem; on read-only deploys (e.g. Vercel) use /tmp/review_archive.db
+ARCHIVE_DB_PATH = os.environ.get("REVIEW_ARCHIVE_DB", "review_archive.db")
+# Reviews older than this are deleted (0 keeps everything)
+ARCHIVE_RETENTION_DAYS = env_int("REVIEW_ARCHIVE_RETENTION_DAYS", 365)
+# Retention runs on the writer thread at most this often
+RETENTION_INTERVAL_SECONDS = 3600
+MAX_QUERY_LIMIT = 500
+
+# Explicit marker the review prompt asks Gemini to end with (prompt version wp-review-v2+)
+SECURITY_MARKER_PATTERN = re.compile(r'\*{0,2}Security findings:?\*{0,2}:?\s*(yes|no)\b', re.IGNORECASE)
+# The whole marker line, removed before the review is posted to the PR
+SECURITY_MARKER_LINE_PATTERN = re.compile(
+    r'^[ \t]*\*{0,2}Security findings:?\*{0,2}:?[ \t]*(?:yes|no)\b.*$\n?', re.IGNORECASE | re.MULTILINE)
+# Fallback for reviews without the marker: security terms not preceded by a negation
+SECURITY_FINDING_PATTERN = re.compile(
+    r'vulnerab|\bxss\b|cross-site|\bcsrf\b|sql injection|unsanitized|unescaped|'
+    r'missing nonce|security (?:issue|risk|concern|flaw|hole)',
+    re.IGNORECASE)
+# A negation only applies when it directly governs the term: "no XSS", "not an XSS risk"
+NEGATION_PATTERN = re.compile(r"(?:\b(?:no|not|never|without|free of)|n't)\s+(?:\S+\s+){0,2}$", re.IGNORECASE)
+# Characters before a security term checked for a governing negation
+NEGATION_WINDOW = 40
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS blobs (
+    hash TEXT PRIMARY KEY,
+    data BLOB NOT NULL,
+    size INTEGER NOT NULL,
+    compressed_size INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS reviews (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    created_at TEXT NOT NULL,
+    trace_id TEXT,
+    repository TEXT,
+    pr_id TEXT,
+    pr_title TEXT,
+    author TEXT,
+    commit_hash TEXT,
+    pr_updated_on TEXT,
+    status TEXT,
+    model TEXT,
+    prompt_version TEXT,
+    prompt_tokens INTEGER,
+    output_tokens INTEGER,
+    total_tokens INTEGER,
+    latency_ms REAL,
+    security_findings INTEGER NOT NULL DEFAULT 0,
+    diff_hash TEXT REFERENCES blobs(hash),
+    prompt_hash TEXT REFERENCES blobs(hash),
+    review_hash TEXT REFERENCES blobs(hash)
+);
+CREATE INDEX IF NOT EXISTS idx_reviews_created_at ON reviews(created_at);
+CREATE INDEX IF NOT EXISTS idx_reviews_repository ON reviews(repository, created_at);
+CREATE INDEX IF NOT EXISTS idx_reviews_pr ON reviews(repository, pr_id);
+CREATE INDEX IF NOT EXISTS idx_reviews_author ON reviews(author, created_at);
+CREATE INDEX IF NOT EXISTS idx_reviews_security ON reviews(security_findings, repository, created_at);
+"""
+
+_METADATA_COLUMNS = [
+    'id', 'created_at', 'trace_id', 'repository', 'pr_id', 'pr_title', 'author',
+    'commit_hash', 'pr_updated_on', 'status', 'model', 'prompt_version',
+    'prompt_tokens', 'output_tokens', 'total_tokens', 'latency_ms', 'security_findings'
+]
+
+_write_queue = queue.Queue()
+_writer_thread = None
+_writer_lock = threading.Lock()
+_last_retention = 0.0
+# Set by init_db; when False, reviews are not archived and the webhook keeps working
+_available = False
+
+
+def _connect() -> sqlite3.Connection:
+    conn = sqlite3.connect(ARCHIVE_DB_PATH, timeout=30)
+    conn.row_factory = sqlite3.Row
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    return conn
+
+
+def init_db() -> bool:
+    """Create the archive tables and indexes if needed
+
+    Returns False (and disables archiving) if the database cannot be opened,
+    e.g. on a read-only filesystem.
+    """
+    global _available
+    try:
+        conn = _connect()
+        try:
+            conn.executescript(_SCHEMA)
+            conn.commit()
+        finally:
+            conn.close()
+        _available = True
+    except sqlite3.Error as e:
+        _available = False
+        logger.error(f"Review archive disabled, cannot open {ARCHIVE_DB_PATH}: {e}")
+    return _available
+
+
+def is_available() -> bool:
+    return _available
+
+
+def _store_blob(conn: sqlite3.Connection, text: str):
+    """Store text as a zlib-compressed blob, deduplicated by SHA-256"""
+    if text is None:
+        return None
+    raw = text.encode('utf-8')
+    digest = hashlib.sha256(raw).hexdigest()
+    exists = conn.execute("SELECT 1 FROM blobs WHERE hash = ?", (digest,)).fetchone()
+    if not exists:
+        data = zlib.compress(raw, 6)
+        conn.execute(
+            "INSERT INTO blobs (hash, data, size, compressed_size) VALUES (?, ?, ?, ?)",
+            (digest, data, len(raw), len(data)))
+    return digest
+
+
+def _load_blob(conn: sqlite3.Connection, digest: str):
+    if not digest:
+        return None
+    row = conn.execute("SELECT data FROM blobs WHERE hash = ?", (digest,)).fetchone()
+    return zlib.decompress(row['data']).decode('utf-8') if row else None
+
+
+def has_security_findings(review_text: str) -> bool:
+    """Whether a review reports security findings
+
+    Uses the explicit "Security findings: yes/no" marker when present, otherwise
+    a keyword heuristic that ignores directly negated terms ("no security issues").
+    """
+    if not review_text:
+        return False
+    markers = SECURITY_MARKER_PATTERN.findall(review_text)
+    if markers:
+        return markers[-1].lower() == 'yes'
+    for match in SECURITY_FINDING_PATTERN.finditer(review_text):
+        preceding = review_text[max(match.start() - NEGATION_WINDOW, 0):match.start()]
+        # Only look at the current sentence or line
+        preceding = re.split(r'[.!?\n]', preceding)[-1]
+        if not NEGATION_PATTERN.search(preceding):
+            return True
+    return False
+
+
+def strip_security_marker(review_text: str) -> str:
+    """Remove the machine-readable "Security findings: yes/no" line from a review"""
+    if not review_text:
+        return review_text
+    return SECURITY_MARKER_LINE_PATTERN.sub('', review_text).rstrip()
+
+
+def _write_review(conn: sqlite3.Connection, record: dict):
+    diff_hash = _store_blob(conn, record.get('diff'))
+    prompt_hash = _store_blob(conn, record.get('prompt'))
+    review_hash = _store_blob(conn, record.get('review'))
+    # Callers that strip the marker before posting pass the flag computed on the raw review
+    security_findings = record.get('security_findings')
+    if security_findings is None:
+        security_findings = has_security_findings(record.get('review'))
+    conn.execute(
+        """INSERT INTO reviews (
+            created_at, trace_id, repository, pr_id, pr_title, author, commit_hash,
+            pr_updated_on, status, model, prompt_version, prompt_tokens, output_tokens,
+            total_tokens, latency_ms, security_findings, diff_hash, prompt_hash, review_hash
+        ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""",
+        (record['created_at'], record.get('trace_id'), record.get('repository'),
+         record.get('pr_id'), record.get('pr_title'), record.get('author'),
+         record.get('commit_hash'), record.get('pr_updated_on'), record.get('status'),
+         record.get('model'), record.get('prompt_version'), record.get('prompt_tokens'),
+         record.get('output_tokens'), record.get('total_tokens'), record.get('latency_ms'),
+         int(security_findings),
+         diff_hash, prompt_hash, review_hash))
+    conn.commit()
+
+
+def _writer_loop():
+    """Single writer thread so SQLite writes never run on request or review threads"""
+    global _last_retention
+    conn = _connect()
+    conn.executescript(_SCHEMA)
+    while True:
+        kind, item = _write_queue.get()
+        if kind == 'stop':
+            _write_queue.task_done()
+            break
+        try:
+            if kind == 'retention':
+                apply_retention(conn, item)
+            else:
+                _write_review(conn, item)
+                if time.time() - _last_retention > RETENTION_INTERVAL_SECONDS:
+                    _last_retention = time.time()
+                    apply_retention(conn)
+        except Exception as e:
+            conn.rollback()
+            logger.error(f"Review archive {kind} failed: {e}")
+        finally:
+            _write_queue.task_done()
+    conn.close()
+
+
+def _ensure_writer():
+    global _writer_thread
+    with _writer_lock:
+        if _writer_thread is None or not _writer_thread.is_alive():
+            if _writer_thread is None:
+                atexit.register(_stop_writer)
+            _writer_thread = threading.Thread(target=_writer_loop, name='review-archive-writer', daemon=True)
+            _writer_thread.start()
+
+
+def _stop_writer():
+    """Flush pending writes on shutdown"""
+    if _writer_thread is not None and _writer_thread.is_alive():
+        _write_queue.put(('stop', None))
+        _writer_thread.join(timeout=10)
+
+
+def archive_review(diff: str, review: str, prompt: str = None, **metadata):
+    """Queue a review for archiving; returns immediately
+
+    Metadata keys match the ``reviews`` columns (repository, pr_id, author,
+    commit_hash, model, prompt_version, prompt_tokens, latency_ms, ...).
+    """
+    record = dict(metadata)
+    record.update({
+        'diff': diff,
+        'review': review,
+        'prompt': prompt,
+        'created_at': datetime.now(timezone.utc).isoformat(timespec='seconds')
+    })
+    if not _available:
+        return
+    _ensure_writer()
+    _write_queue.put(('review', record))
+
+
+def schedule_retention(retention_days: int = None):
+    """Run retention on the writer thread so it never races with an insert"""
+    if not _available:
+        return
+    _ensure_writer()
+    _write_queue.put(('retention', retention_days))
+
+
+def pr_metadata(payload: dict) -> dict:
+    """Extract archive metadata from a Bitbucket pull request webhook payload"""
+    pr_data = payload.get('pullrequest', {})
+    author = pr_data.get('author') or {}
+    return {
+        'repository': payload.get('repository', {}).get('full_name'),
+        'pr_id': str(pr_data.get('id', 'unknown')),
+        'pr_title': pr_data.get('title'),
+        'author': author.get('nickname') or author.get('display_name'),
+        'commit_hash': pr_data.get('source', {}).get('commit', {}).get('hash'),
+        'pr_updated_on': pr_data.get('updated_on')
+    }
+
+
+def apply_retention(conn: sqlite3.Connection = None, retention_days: int = None) -> dict:
+    """Delete reviews past the retention period and blobs no review references
+
+    Prefer ``schedule_retention`` while the app is running.
+    """
+    retention_days = ARCHIVE_RETENTION_DAYS if retention_days is None else retention_days
+    own_conn = conn is None
+    if own_conn:
+        conn = _connect()
+    try:
+        deleted_reviews = 0
+        if retention_days > 0:
+            cutoff = (datetime.now(timezone.utc) - timedelta(days=retention_days)).isoformat(timespec='seconds')
+            deleted_reviews = conn.execute("DELETE FROM reviews WHERE created_at < ?", (cutoff,)).rowcount
+        deleted_blobs = conn.execute(
+            """DELETE FROM blobs WHERE hash NOT IN (
+                SELECT diff_hash FROM reviews WHERE diff_hash IS NOT NULL
+                UNION SELECT prompt_hash FROM reviews WHERE prompt_hash IS NOT NULL
+                UNION SELECT review_hash FROM reviews WHERE review_hash IS NOT NULL
+            )""").rowcount
+        conn.commit()
+        if deleted_reviews or deleted_blobs:
+            logger.info(f"Archive retention removed {deleted_reviews} reviews and {deleted_blobs} blobs")
+        return {'deleted_reviews': deleted_reviews, 'deleted_blobs': deleted_blobs}
+    finally:
+        if own_conn:
+            conn.close()
+
+
+def query_reviews(repository: str = None, pr_id: str = None, author: str = None,
+                  since: str = None, until: str = None, security_findings: bool = None,
+                  status: str = None, limit: int = 50, offset: int = 0) -> list:
+    """Return review metadata (newest first) matching the given filters
+
+    ``since`` and ``until`` are ISO 8601 dates or timestamps (UTC).
+    """
+    clauses = []
+    params = []
+    for column, value in (('repository', repository), ('pr_id', pr_id),
+                          ('author', author), ('status', status)):
+        if value is not None:
+            clauses.append(f"{column} = ?")
+            params.append(value)
+    if since:
+        clauses.append("created_at >= ?")
+        params.append(since)
+    if until:
+        clauses.append("created_at < ?")
+        params.append(until)
+    if security_findings is not None:
+        clauses.append("security_findings = ?")
+        params.append(int(security_findings))
+
+    where = f"WHERE {' AND '.join(clauses)}" if clauses else ""
+    sql = (f"SELECT {', '.join(_METADATA_COLUMNS)} FROM reviews {where} "
+           f"ORDER BY created_at DESC, id DESC LIMIT ? OFFSET ?")
+    params.extend([min(max(int(limit), 1), MAX_QUERY_LIMIT), max(int(offset), 0)])
+
+    conn = _connect()
+    try:
+        return [dict(row) for row in conn.execute(sql, params)]
+    finally:
+        conn.close()
+
+
+def get_review(review_id: int):
+    """Return one review with its decompressed diff, prompt template and review text"""
+    conn = _connect()
+    try:
+        row = conn.execute("SELECT * FROM reviews WHERE id = ?", (review_id,)).fetchone()
+        if not row:
+            return None
+        review = {column: row[column] for column in _METADATA_COLUMNS}
+        review['diff'] = _load_blob(conn, row['diff_hash'])
+        review['prompt'] = _load_blob(conn, row['prompt_hash'])
+        review['review'] = _load_blob(conn, row['review_hash'])
+        return review
+    finally:
+        conn.close()
+
+
+def archive_stats() -> dict:
+    """Summary of archive size and compression"""
+    conn = _connect()
+    try:
+        reviews = conn.execute(
+            "SELECT COUNT(*) AS count, MIN(created_at) AS oldest, MAX(created_at) AS newest FROM reviews"
+        ).fetchone()
+        blobs = conn.execute(
+            "SELECT COUNT(*) AS count, COALESCE(SUM(size), 0) AS size, "
+            "COALESCE(SUM(compressed_size), 0) AS compressed_size FROM blobs"
+        ).fetchone()
+        return {
+            'reviews': reviews['count'],
+            'oldest': reviews['oldest'],
+            'newest': reviews['newest'],
+            'blobs': blobs['count'],
+            'raw_bytes': blobs['size'],
+            'compressed_bytes': blobs['compressed_size'],
+            'retention_days': ARCHIVE_RETENTION_DAYS,
+            'pending_writes': _write_queue.qsize()
+        }
+    finally:
+        conn.close()
@@ -0,0 +1,123 @@
+import time
+from collections import deque
+
+import pytest
+
+import circuit_breaker
+from circuit_breaker import CircuitBreaker, CLOSED, OPEN, HALF_OPEN, UpstreamUnavailable
+
+RECOVERY = 0.05
+
+
+def make_breaker(**kwargs):
+    options = {'failure_threshold': 2, 'recovery_timeout': RECOVERY,
+               'half_open_max_calls': 1, 'success_threshold': 1}
+    options.update(kwargs)
+    return CircuitBreaker('test', **options)
+
+
+@pytest.fixture
+def parked(monkeypatch):
+    """Isolated 'test' upstream with the background replayer disabled"""
+    breaker = make_breaker()
+    monkeypatch.setitem(circuit_breaker.breakers, 'test', breaker)
+    monkeypatch.setitem(circuit_breaker._parked, 'test', deque())
+    monkeypatch.setattr(circuit_breaker, '_last_trial_release', {})
+    monkeypatch.setattr(circuit_breaker, '_ensure_replayer', lambda: None)
+    return breaker
+
+
+def test_closed_open_half_open_closed():
+    breaker = make_breaker()
+
+    breaker.record_failure('boom')
+    assert breaker.state == CLOSED
+    breaker.record_failure('boom')
+    assert breaker.state == OPEN
+    assert not breaker.allow_request()
+
+    time.sleep(RECOVERY + 0.01)
+    assert breaker.allow_request()
+    assert breaker.state == HALF_OPEN
+
+    breaker.record_success()
+    assert breaker.state == CLOSED
+
+
+def test_success_resets_consecutive_failures():
+    breaker = make_breaker()
+
+    breaker.record_failure()
+    breaker.record_success()
+    breaker.record_failure()
+
+    assert breaker.state == CLOSED
+
+
+def test_half_open_rejects_second_caller_until_trial_finishes():
+    breaker = make_breaker()
+    breaker.record_failure()
+    breaker.record_failure()
+    time.sleep(RECOVERY + 0.01)
+
+    assert breaker.allow_request()
+    assert not breaker.allow_request()
+    with pytest.raises(UpstreamUnavailable):
+        breaker.check()
+
+
+def test_failed_trial_reopens_breaker():
+    breaker = make_breaker()
+    breaker.record_failure()
+    breaker.record_failure()
+    time.sleep(RECOVERY + 0.01)
+
+    assert breaker.allow_request()
+    breaker.record_failure('still down')
+
+    assert breaker.state == OPEN
+    assert not breaker.allow_request()
+
+
+def test_replay_backoff_doubles():
+    assert circuit_breaker.replay_backoff(0) == 0
+    assert circuit_breaker.replay_backoff(1) == circuit_breaker.REPLAY_BACKOFF_SECONDS
+    assert circuit_breaker.replay_backoff(3) == circuit_breaker.REPLAY_BACKOFF_SECONDS * 4
+
+
+def test_closed_breaker_releases_jobs_only_after_their_backoff(parked):
+    circuit_breaker.park('test', lambda: None, 'outage job', failures=0)
+    circuit_breaker.park('test', lambda: None, 'failing job', failures=1)
+    now = time.time()
+
+    released = circuit_breaker._jobs_to_release('test', parked, now)
+    assert [job['description'] for job in released] == ['outage job']
+
+    later = now + circuit_breaker.replay_backoff(1) + 1
+    released = circuit_breaker._jobs_to_release('test', parked, later)
+    assert [job['description'] for job in released] == ['failing job']
+
+
+def test_open_breaker_releases_one_trial_job_per_recovery_period(parked):
+    parked.record_failure()
+    parked.record_failure()
+    circuit_breaker.park('test', lambda: None, 'job 1')
+    circuit_breaker.park('test', lambda: None, 'job 2')
+
+    assert circuit_breaker._jobs_to_release('test', parked) == []
+
+    time.sleep(RECOVERY + 0.01)
+    released = circuit_breaker._jobs_to_release('test', parked)
+    assert [job['description'] for job in released] == ['job 1']
+    assert circuit_breaker._jobs_to_release('test', parked) == []
+
+
+def test_dropped_parked_job_is_reported(parked, monkeypatch):
+    monkeypatch.setattr(circuit_breaker, 'MAX_PARKED_JOBS', 1)
+    dropped = []
+
+    circuit_breaker.park('test', lambda: None, 'job 1', on_drop=lambda: dropped.append('job 1'))
+    circuit_breaker.park('test', lambda: None, 'job 2', on_drop=lambda: dropped.append('job 2'))
+
+    assert dropped == ['job 1']
+    assert [job['description'] for job in circuit_breaker._parked['test']] == ['job 2']
@@ -0,0 +1,24 @@
+from env_config import env_float, env_int, env_number
+
+
+def test_reads_valid_numbers(monkeypatch):
+    monkeypatch.setenv('WORKER_COUNT', ' 8 ')
+    monkeypatch.setenv('BREAKER_RECOVERY_SECONDS', '2.5')
+
+    assert env_int('WORKER_COUNT', 4) == 8
+    assert env_float('BREAKER_RECOVERY_SECONDS', 60.0) == 2.5
+
+
+def test_missing_or_empty_value_uses_default(monkeypatch):
+    monkeypatch.delenv('WORKER_COUNT', raising=False)
+    monkeypatch.setenv('MAX_PARKED_JOBS', '')
+
+    assert env_int('WORKER_COUNT', 4) == 4
+    assert env_int('MAX_PARKED_JOBS', 500) == 500
+
+
+def test_invalid_value_falls_back_with_warning(monkeypatch, caplog):
+    monkeypatch.setenv('WORKER_COUNT', 'four')
+
+    assert env_number('WORKER_COUNT', 4, int) == 4
+    assert "Invalid value 'four' for WORKER_COUNT, using 4" in caplog.text
@@ -0,0 +1,69 @@
+import threading
+
+from job_scheduler import FairScheduler
+
+
+def run_jobs(scheduler, submissions, timeout=5):
+    """Submit jobs while a gate job holds the only worker, then return the run order"""
+    order = []
+    done = threading.Event()
+    gate = threading.Event()
+    scheduler.submit('gate', gate.wait)
+
+    def make_job(name):
+        def job():
+            order.append(name)
+            if len(order) == len(submissions):
+                done.set()
+        return job
+
+    for repository, name, is_new_pr in submissions:
+        scheduler.submit(repository, make_job(name), is_new_pr=is_new_pr)
+    gate.set()
+    assert done.wait(timeout)
+    return order
+
+
+def test_new_prs_in_one_repo_do_not_starve_other_repos():
+    scheduler = FairScheduler(workers=1, weights={}, concurrency={}, token_quotas={})
+    submissions = [('busy', f'busy-new{i}', True) for i in range(5)]
+    submissions += [('quiet', f'quiet-upd{i}', False) for i in range(2)]
+
+    order = run_jobs(scheduler, submissions)
+
+    assert order[:4] == ['busy-new0', 'quiet-upd0', 'busy-new1', 'quiet-upd1']
+
+
+def test_new_prs_run_before_updates_within_a_repo():
+    scheduler = FairScheduler(workers=1, weights={}, concurrency={}, token_quotas={})
+    submissions = [
+        ('repo', 'update0', False),
+        ('repo', 'update1', False),
+        ('repo', 'new0', True),
+    ]
+
+    order = run_jobs(scheduler, submissions)
+
+    assert order == ['new0', 'update0', 'update1']
+
+
+def test_weights_share_workers_proportionally():
+    scheduler = FairScheduler(workers=1, weights={'heavy': 2}, concurrency={}, token_quotas={})
+    submissions = [('heavy', f'heavy{i}', False) for i in range(4)]
+    submissions += [('light', f'light{i}', False) for i in range(2)]
+
+    order = run_jobs(scheduler, submissions)
+
+    assert order == ['heavy0', 'light0', 'heavy1', 'heavy2', 'light1', 'heavy3']
+
+
+def test_token_quota_holds_back_repository():
+    scheduler = FairScheduler(workers=1, weights={}, concurrency={}, token_quotas={'limited': 100})
+    scheduler.record_token_usage('limited', 150)
+    ran = threading.Event()
+    scheduler.submit('limited', ran.set)
+
+    assert not ran.wait(0.3)
+    stats = scheduler.stats()['repositories']['limited']
+    assert stats['queued'] == 1
+    assert stats['tokens_last_hour'] == 150
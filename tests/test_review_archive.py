@@ -0,0 +1,139 @@
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+import review_archive
+from review_archive import has_security_findings
+
+
+@pytest.fixture
+def archive(tmp_path, monkeypatch):
+    """Archive database in a temporary directory; yields a connection for direct writes"""
+    monkeypatch.setattr(review_archive, 'ARCHIVE_DB_PATH', str(tmp_path / 'archive.db'))
+    monkeypatch.setattr(review_archive, '_available', False)
+    assert review_archive.init_db()
+    conn = review_archive._connect()
+    yield conn
+    conn.close()
+
+
+def write(conn, days_ago=0, **fields):
+    created_at = datetime.now(timezone.utc) - timedelta(days=days_ago)
+    record = {
+        'diff': 'diff --git a/plugin.php b/plugin.php',
+        'review': 'Looks good.',
+        'repository': 'team/plugin',
+        'pr_id': '1',
+        'author': 'alice',
+        'status': 'success',
+        'created_at': created_at.isoformat(timespec='seconds')
+    }
+    record.update(fields)
+    review_archive._write_review(conn, record)
+
+
+def blob_count(conn):
+    return conn.execute("SELECT COUNT(*) FROM blobs").fetchone()[0]
+
+
+def test_init_db_reports_unwritable_path(tmp_path, monkeypatch):
+    monkeypatch.setattr(review_archive, 'ARCHIVE_DB_PATH', str(tmp_path / 'missing' / 'archive.db'))
+    monkeypatch.setattr(review_archive, '_available', True)
+
+    assert not review_archive.init_db()
+    assert not review_archive.is_available()
+
+
+def test_identical_texts_are_stored_once(archive):
+    write(archive, prompt='template', pr_id='1')
+    write(archive, prompt='template', pr_id='2')
+
+    assert blob_count(archive) == 3
+    review = review_archive.get_review(2)
+    assert review['diff'] == 'diff --git a/plugin.php b/plugin.php'
+    assert review['prompt'] == 'template'
+    assert review['review'] == 'Looks good.'
+
+
+def test_retention_deletes_old_reviews_and_unreferenced_blobs(archive):
+    write(archive, days_ago=100, diff='old diff', pr_id='1')
+    write(archive, days_ago=1, pr_id='2')
+
+    result = review_archive.apply_retention(archive, retention_days=30)
+
+    assert result == {'deleted_reviews': 1, 'deleted_blobs': 1}
+    assert [review['pr_id'] for review in review_archive.query_reviews()] == ['2']
+    # The shared review text is still referenced by the remaining review
+    assert blob_count(archive) == 2
+
+
+def test_retention_zero_keeps_everything(archive):
+    write(archive, days_ago=1000)
+
+    assert review_archive.apply_retention(archive, retention_days=0) == {'deleted_reviews': 0, 'deleted_blobs': 0}
+
+
+def test_query_filters_by_date_range(archive):
+    write(archive, days_ago=10, pr_id='old')
+    write(archive, days_ago=5, pr_id='middle')
+    write(archive, days_ago=0, pr_id='new')
+    since = (datetime.now(timezone.utc) - timedelta(days=7)).date().isoformat()
+    until = (datetime.now(timezone.utc) - timedelta(days=2)).date().isoformat()
+
+    reviews = review_archive.query_reviews(since=since, until=until)
+
+    assert [review['pr_id'] for review in reviews] == ['middle']
+
+
+def test_query_filters_by_security_flag(archive):
+    write(archive, pr_id='flagged', review='Stored XSS.\n**Security findings:** yes')
+    write(archive, pr_id='clean', review='Looks good.\n**Security findings:** no')
+    write(archive, pr_id='explicit', review='Looks good.', security_findings=True)
+
+    flagged = review_archive.query_reviews(security_findings=True)
+    clean = review_archive.query_reviews(security_findings=False)
+
+    assert sorted(review['pr_id'] for review in flagged) == ['explicit', 'flagged']
+    assert [review['pr_id'] for review in clean] == ['clean']
+
+
+def test_query_filters_by_repository_and_author(archive):
+    write(archive, repository='team/plugin', author='alice', pr_id='1')
+    write(archive, repository='team/theme', author='alice', pr_id='2')
+    write(archive, repository='team/plugin', author='bob', pr_id='3')
+
+    reviews = review_archive.query_reviews(repository='team/plugin', author='alice')
+
+    assert [review['pr_id'] for review in reviews] == ['1']
+
+
+def test_security_marker_takes_precedence():
+    assert has_security_findings("Possible XSS in the widget.\n**Security findings:** no") is False
+    assert has_security_findings("Looks good.\n**Security findings:** yes") is True
+
+
+@pytest.mark.parametrize('text', [
+    "Any logged-in user can trigger stored XSS.",
+    "There is no escaping here, which allows XSS.",
+    "Looks good, no XSS. But the form is missing nonce checks.",
+    "The title is echoed unescaped.",
+])
+def test_keyword_fallback_flags_findings(text):
+    assert has_security_findings(text) is True
+
+
+@pytest.mark.parametrize('text', [
+    "No security issues found.",
+    "This does not introduce an XSS risk.",
+    "The change doesn't add any vulnerabilities.",
+    "Looks good to me.",
+    "",
+])
+def test_keyword_fallback_ignores_negated_terms(text):
+    assert has_security_findings(text) is False
+
+
+def test_strip_security_marker():
+    review = "Escape the title.\n\n**Security findings:** yes\n"
+
+    assert review_archive.strip_security_marker(review) == "Escape the title."
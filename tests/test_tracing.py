@@ -0,0 +1,129 @@
+import json
+
+import pytest
+
+pytest.importorskip("requests")
+
+import tracing
+
+
+@pytest.fixture
+def trace(monkeypatch):
+    # Keep finished test traces out of the exporter
+    monkeypatch.setattr(tracing, '_export', lambda trace: None)
+    trace = tracing.start_trace('webhook', repository='team/plugin')
+    yield trace
+    tracing.detach()
+
+
+@pytest.fixture
+def profiling(monkeypatch):
+    monkeypatch.setattr(tracing, '_profiling', {'enabled': False, 'sample_rate': 0.1, 'top_n': 25})
+
+
+def spans_by_name(trace):
+    return {record['name']: record for record in trace['spans']}
+
+
+def test_spans_nest_under_the_enclosing_span(trace):
+    with tracing.span('review_diff'):
+        with tracing.span('gemini.analyze', attempt=1):
+            pass
+    with tracing.span('publish_review'):
+        pass
+
+    spans = spans_by_name(trace)
+    assert spans['review_diff']['parent_id'] is None
+    assert spans['gemini.analyze']['parent_id'] == spans['review_diff']['span_id']
+    assert spans['gemini.analyze']['attributes'] == {'attempt': 1}
+    assert spans['publish_review']['parent_id'] is None
+    assert all(record['duration_ms'] is not None for record in trace['spans'])
+
+
+def test_failing_span_records_error_and_reraises(trace):
+    with pytest.raises(RuntimeError):
+        with tracing.span('review_diff'):
+            with tracing.span('gemini.analyze'):
+                raise RuntimeError("quota exceeded")
+
+    spans = spans_by_name(trace)
+    assert spans['gemini.analyze']['status'] == 'error'
+    assert spans['gemini.analyze']['attributes']['error'] == "RuntimeError: quota exceeded"
+    assert spans['review_diff']['status'] == 'error'
+
+
+def test_run_in_trace_marks_failed_job(monkeypatch, profiling):
+    monkeypatch.setattr(tracing, '_export', lambda trace: None)
+    job_trace = tracing.start_trace('webhook')
+    tracing.detach()
+
+    with pytest.raises(ValueError):
+        with tracing.run_in_trace(job_trace):
+            raise ValueError("bad payload")
+
+    assert job_trace['status'] == 'error'
+    assert job_trace['duration_ms'] is not None
+    assert tracing.current_trace() is None
+
+
+def test_span_without_trace_is_a_no_op():
+    tracing.detach()
+
+    with tracing.span('orphan') as record:
+        assert record is None
+
+
+@pytest.mark.parametrize('value, expected', [
+    (True, True), (False, False), ("true", True), ("ON", True), (" 1 ", True),
+    ("false", False), ("off", False), ("0", False), ("", False),
+])
+def test_parse_bool(value, expected):
+    assert tracing.parse_bool(value) is expected
+
+
+@pytest.mark.parametrize('value', ["maybe", 1, None, []])
+def test_parse_bool_rejects_other_values(value):
+    with pytest.raises(ValueError):
+        tracing.parse_bool(value)
+
+
+def test_set_profiling_validates_and_clamps(profiling):
+    config = tracing.set_profiling(enabled="false", sample_rate=5, top_n=0)
+
+    assert config == {'enabled': False, 'sample_rate': 1.0, 'top_n': 1}
+    with pytest.raises(ValueError):
+        tracing.set_profiling(enabled="sometimes")
+    with pytest.raises(ValueError):
+        tracing.set_profiling(sample_rate="often")
+    assert tracing.get_profiling_config() == config
+
+
+def test_to_otlp_links_spans_to_their_parents(trace):
+    with tracing.span('review_diff'):
+        with tracing.span('gemini.analyze'):
+            pass
+    tracing.finish_trace(trace)
+
+    spans = tracing._to_otlp(trace)['resourceSpans'][0]['scopeSpans'][0]['spans']
+    root, *children = spans
+    by_name = {record['name']: record for record in children}
+
+    assert {record['traceId'] for record in spans} == {trace['trace_id']}
+    assert len(root['spanId']) == 16 and 'parentSpanId' not in root
+    assert by_name['review_diff']['parentSpanId'] == root['spanId']
+    assert by_name['gemini.analyze']['parentSpanId'] == by_name['review_diff']['spanId']
+    assert {'key': 'repository', 'value': {'stringValue': 'team/plugin'}} in root['attributes']
+
+
+def test_export_file_is_rotated_at_size_cap(tmp_path, monkeypatch, trace):
+    export_file = tmp_path / 'traces.jsonl'
+    monkeypatch.setattr(tracing, 'TRACE_EXPORT_FILE', str(export_file))
+    monkeypatch.setattr(tracing, 'OTLP_TRACES_ENDPOINT', None)
+    monkeypatch.setattr(tracing, 'TRACE_EXPORT_MAX_BYTES', 10)
+    tracing.finish_trace(trace)
+
+    tracing._write_trace(trace)
+    tracing._write_trace(trace)
+
+    assert json.loads(export_file.read_text())['trace_id'] == trace['trace_id']
+    assert (tmp_path / 'traces.jsonl.1').exists()
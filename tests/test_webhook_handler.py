@@ -0,0 +1,81 @@
+import pytest
+
+pytest.importorskip("requests")
+pytest.importorskip("httpx")
+pytest.importorskip("google.genai")
+
+import webhook_handler
+from circuit_breaker import UpstreamUnavailable
+
+PAYLOAD = {
+    "repository": {"full_name": "team/plugin"},
+    "pullrequest": {"id": 1, "title": "Test PR", "state": "OPEN"}
+}
+COMMENTS_URL = "https://api.bitbucket.org/2.0/repositories/team/plugin/pullrequests/1/comments"
+
+
+@pytest.fixture
+def archived(monkeypatch):
+    records = []
+    monkeypatch.setattr(webhook_handler.review_archive, 'archive_review',
+                        lambda *args, **kwargs: records.append(kwargs))
+    return records
+
+
+@pytest.fixture
+def gemini_calls(monkeypatch, archived):
+    calls = []
+
+    def fake_analyze(diff, details=None):
+        calls.append(diff)
+        return "Avoid echoing $_GET unescaped.\n\n**Security findings:** yes\n"
+
+    monkeypatch.setattr(webhook_handler, 'analyze_code_with_gemini', fake_analyze)
+    return calls
+
+
+def test_parked_publish_resumes_without_calling_gemini_again(monkeypatch, gemini_calls):
+    posted = []
+
+    def bitbucket_down(comments_url, comment):
+        raise UpstreamUnavailable('bitbucket', 'Bitbucket unavailable')
+
+    monkeypatch.setattr(webhook_handler, 'post_comment_to_bitbucket', bitbucket_down)
+    with pytest.raises(UpstreamUnavailable) as parked:
+        webhook_handler.review_diff(PAYLOAD, COMMENTS_URL, "diff")
+    assert parked.value.resume is not None
+
+    monkeypatch.setattr(webhook_handler, 'post_comment_to_bitbucket',
+                        lambda comments_url, comment: posted.append(comment))
+    result = parked.value.resume()
+
+    assert len(gemini_calls) == 1
+    assert posted == [result]
+
+
+def test_security_marker_is_classified_but_not_posted(monkeypatch, gemini_calls, archived):
+    posted = []
+    monkeypatch.setattr(webhook_handler, 'post_comment_to_bitbucket',
+                        lambda comments_url, comment: posted.append(comment))
+
+    webhook_handler.review_diff(PAYLOAD, COMMENTS_URL, "diff")
+
+    assert posted == ["Avoid echoing $_GET unescaped."]
+    assert archived[0]['review'] == "Avoid echoing $_GET unescaped."
+    assert archived[0]['security_findings'] is True
+
+
+def test_parked_review_resumes_from_gemini_stage(monkeypatch):
+    attempts = []
+
+    def gemini_down(diff, details=None):
+        attempts.append(diff)
+        raise UpstreamUnavailable('gemini', 'Gemini unavailable')
+
+    monkeypatch.setattr(webhook_handler, 'analyze_code_with_gemini', gemini_down)
+    with pytest.raises(UpstreamUnavailable) as parked:
+        webhook_handler.review_diff(PAYLOAD, COMMENTS_URL, "diff")
+
+    with pytest.raises(UpstreamUnavailable):
+        parked.value.resume()
+    assert attempts == ["diff", "diff"]
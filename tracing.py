@@ -0,0 +1,367 @@
+import os
+import io
+import json
+import time
+import queue
+import atexit
+import uuid
+import random
+import logging
+import threading
+import cProfile
+import pstats
+from collections import deque
+from contextlib import contextmanager
+from functools import wraps
+
+import requests
+
+from env_config import env_float, env_int
+
+logger = logging.getLogger(__name__)
+
+# --- Configuration ---
+# Optional JSON lines file for finished traces, e.g. traces.jsonl (off by default; must be writable)
+TRACE_EXPORT_FILE = os.environ.get("TRACE_EXPORT_FILE", "")
+# The export file is rotated to <file>.1 once it reaches this size
+TRACE_EXPORT_MAX_BYTES = env_int("TRACE_EXPORT_MAX_BYTES", 10 * 1024 * 1024)
+# Optional OTLP/HTTP JSON collector, e.g. http://localhost:4318/v1/traces
+OTLP_TRACES_ENDPOINT = os.environ.get("OTEL_EXPORTER_OTLP_TRACES_ENDPOINT")
+SERVICE_NAME = os.environ.get("OTEL_SERVICE_NAME", "bitbucket-gemini-review")
+MAX_RECENT_TRACES = 200
+# Finished traces waiting for the exporter thread; extra traces are dropped, not blocked on
+MAX_PENDING_EXPORTS = 1000
+
+_local = threading.local()
+_lock = threading.Lock()
+_recent_traces = deque(maxlen=MAX_RECENT_TRACES)
+
+_export_queue = queue.Queue(maxsize=MAX_PENDING_EXPORTS)
+_exporter_thread = None
+_exporter_lock = threading.Lock()
+
+TRUE_VALUES = ("1", "true", "yes", "on")
+FALSE_VALUES = ("0", "false", "no", "off", "")
+
+
+def parse_bool(value) -> bool:
+    """Parse a bool or a string such as "true"/"false"; raises ValueError otherwise"""
+    if isinstance(value, bool):
+        return value
+    if isinstance(value, str):
+        if value.strip().lower() in TRUE_VALUES:
+            return True
+        if value.strip().lower() in FALSE_VALUES:
+            return False
+    raise ValueError(f"Expected a boolean, got {value!r}")
+
+
+# Only one cProfile profiler can be active per process at a time
+_profiler_lock = threading.Lock()
+_profiling = {
+    'enabled': os.environ.get("PROFILE_JOBS", "").lower() in TRUE_VALUES,
+    'sample_rate': env_float("PROFILE_SAMPLE_RATE", 0.1),
+    'top_n': 25
+}
+
+
+def _span_id() -> str:
+    return uuid.uuid4().hex[:16]
+
+
+def start_trace(name: str, **attributes) -> dict:
+    """Create a new trace and make it current for this thread"""
+    trace = {
+        'trace_id': uuid.uuid4().hex,
+        'name': name,
+        'start': time.time(),
+        'duration_ms': None,
+        'status': 'ok',
+        'attributes': attributes,
+        'spans': [],
+        'profile': None
+    }
+    attach(trace)
+    return trace
+
+
+def attach(trace: dict):
+    """Make an existing trace current for this thread (e.g. a worker thread)"""
+    _local.trace = trace
+    _local.stack = []
+
+
+def detach():
+    """Clear the current trace for this thread"""
+    _local.trace = None
+    _local.stack = []
+
+
+def current_trace():
+    return getattr(_local, 'trace', None)
+
+
+def get_trace_id():
+    """Return the trace ID of the current thread, or None"""
+    trace = current_trace()
+    return trace['trace_id'] if trace else None
+
+
+def finish_trace(trace: dict, status: str = None):
+    """Close a trace, keep it in memory and queue it for export"""
+    trace['duration_ms'] = round((time.time() - trace['start']) * 1000, 2)
+    if status:
+        trace['status'] = status
+
+    with _lock:
+        _recent_traces.append(trace)
+
+    if current_trace() is trace:
+        detach()
+
+    _export(trace)
+
+
+@contextmanager
+def span(name: str, **attributes):
+    """Record a timed span inside the current trace (no-op without a trace)"""
+    trace = current_trace()
+    if trace is None:
+        yield None
+        return
+
+    stack = _local.stack
+    record = {
+        'span_id': _span_id(),
+        'parent_id': stack[-1]['span_id'] if stack else None,
+        'name': name,
+        'start': time.time(),
+        'duration_ms': None,
+        'status': 'ok',
+        'attributes': dict(attributes)
+    }
+    stack.append(record)
+    try:
+        yield record
+    except Exception as e:
+        record['status'] = 'error'
+        record['attributes']['error'] = f"{type(e).__name__}: {e}"
+        raise
+    finally:
+        record['duration_ms'] = round((time.time() - record['start']) * 1000, 2)
+        stack.pop()
+        trace['spans'].append(record)
+
+
+def traced(name: str):
+    """Decorator that wraps a function call in a span"""
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            with span(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+@contextmanager
+def run_in_trace(trace: dict):
+    """Attach a trace in a worker thread, optionally profile the job, then finish the trace"""
+    attach(trace)
+    profiler = _maybe_start_profiler()
+    status = None
+    try:
+        yield trace
+    except Exception:
+        status = 'error'
+        raise
+    finally:
+        if profiler:
+            trace['profile'] = _stop_profiler(profiler)
+        finish_trace(trace, status)
+
+
+class TraceIdFilter(logging.Filter):
+    """Adds the current trace ID to every log record as ``trace_id``"""
+
+    def filter(self, record):
+        record.trace_id = get_trace_id() or '-'
+        return True
+
+
+# --- Profiling ---
+
+def set_profiling(enabled: bool = None, sample_rate: float = None, top_n: int = None) -> dict:
+    """Update the sampled job profiling settings; raises ValueError on invalid values"""
+    if enabled is not None:
+        enabled = parse_bool(enabled)
+    with _lock:
+        if enabled is not None:
+            _profiling['enabled'] = enabled
+        if sample_rate is not None:
+            _profiling['sample_rate'] = min(max(float(sample_rate), 0.0), 1.0)
+        if top_n is not None:
+            _profiling['top_n'] = max(int(top_n), 1)
+        return dict(_profiling)
+
+
+def get_profiling_config() -> dict:
+    with _lock:
+        return dict(_profiling)
+
+
+def _maybe_start_profiler():
+    if not _profiling['enabled'] or random.random() >= _profiling['sample_rate']:
+        return None
+    if not _profiler_lock.acquire(blocking=False):
+        # Another job is already being profiled
+        return None
+    try:
+        profiler = cProfile.Profile()
+        profiler.enable()
+        return profiler
+    except Exception as e:
+        _profiler_lock.release()
+        logger.warning(f"Failed to start profiler: {e}")
+        return None
+
+
+def _stop_profiler(profiler) -> str:
+    try:
+        profiler.disable()
+        output = io.StringIO()
+        stats = pstats.Stats(profiler, stream=output)
+        stats.sort_stats('cumulative').print_stats(_profiling['top_n'])
+        return output.getvalue()
+    finally:
+        _profiler_lock.release()
+
+
+# --- Queries ---
+
+def get_slowest_traces(limit: int = 10, include_profile: bool = True) -> list:
+    """Return the slowest recently finished traces"""
+    with _lock:
+        traces = list(_recent_traces)
+    traces.sort(key=lambda t: t['duration_ms'] or 0, reverse=True)
+    result = []
+    for trace in traces[:limit]:
+        item = dict(trace)
+        if not include_profile:
+            item.pop('profile', None)
+        result.append(item)
+    return result
+
+
+# --- Export ---
+
+def _export(trace: dict):
+    """Hand a finished trace to the exporter thread; never blocks the caller"""
+    if not TRACE_EXPORT_FILE and not OTLP_TRACES_ENDPOINT:
+        return
+    _ensure_exporter()
+    try:
+        _export_queue.put_nowait(trace)
+    except queue.Full:
+        logger.warning(f"Trace export queue full, dropping trace {trace['trace_id']}")
+
+
+def _ensure_exporter():
+    global _exporter_thread
+    with _exporter_lock:
+        if _exporter_thread is None or not _exporter_thread.is_alive():
+            if _exporter_thread is None:
+                atexit.register(_stop_exporter)
+            _exporter_thread = threading.Thread(target=_exporter_loop, name='trace-exporter', daemon=True)
+            _exporter_thread.start()
+
+
+def _stop_exporter():
+    """Flush pending exports on shutdown"""
+    if _exporter_thread is not None and _exporter_thread.is_alive():
+        try:
+            _export_queue.put(None, timeout=1)
+        except queue.Full:
+            return
+        _exporter_thread.join(timeout=10)
+
+
+def _exporter_loop():
+    """Single exporter thread so file and network I/O never run on request or review threads"""
+    while True:
+        trace = _export_queue.get()
+        if trace is None:
+            break
+        try:
+            _write_trace(trace)
+        except Exception as e:
+            logger.error(f"Trace export failed: {e}")
+
+
+def _rotate_export_file():
+    """Keep the export file below TRACE_EXPORT_MAX_BYTES, holding one previous file"""
+    try:
+        if os.path.getsize(TRACE_EXPORT_FILE) >= TRACE_EXPORT_MAX_BYTES:
+            os.replace(TRACE_EXPORT_FILE, TRACE_EXPORT_FILE + '.1')
+    except FileNotFoundError:
+        pass
+
+
+def _write_trace(trace: dict):
+    if TRACE_EXPORT_FILE:
+        try:
+            record = {k: v for k, v in trace.items() if k != 'profile'}
+            _rotate_export_file()
+            with open(TRACE_EXPORT_FILE, 'a') as f:
+                f.write(json.dumps(record) + "\n")
+        except Exception as e:
+            logger.error(f"Failed to export trace to file: {e}")
+
+    if OTLP_TRACES_ENDPOINT:
+        try:
+            requests.post(OTLP_TRACES_ENDPOINT, json=_to_otlp(trace), timeout=5)
+        except requests.exceptions.RequestException as e:
+            logger.warning(f"Failed to export trace to OTLP endpoint: {e}")
+
+
+def _otlp_attributes(attributes: dict) -> list:
+    return [{'key': key, 'value': {'stringValue': str(value)}}
+            for key, value in attributes.items()]
+
+
+def _to_otlp(trace: dict) -> dict:
+    """Convert a trace to the OTLP/HTTP JSON encoding"""
+    root_id = _span_id()
+
+    def nanos(seconds):
+        return str(int(seconds * 1_000_000_000))
+
+    spans = [{
+        'traceId': trace['trace_id'],
+        'spanId': root_id,
+        'name': trace['name'],
+        'kind': 2,
+        'startTimeUnixNano': nanos(trace['start']),
+        'endTimeUnixNano': nanos(trace['start'] + (trace['duration_ms'] or 0) / 1000),
+        'attributes': _otlp_attributes(trace['attributes']),
+        'status': {'code': 2 if trace['status'] == 'error' else 1}
+    }]
+    for record in trace['spans']:
+        spans.append({
+            'traceId': trace['trace_id'],
+            'spanId': record['span_id'],
+            'parentSpanId': record['parent_id'] or root_id,
+            'name': record['name'],
+            'kind': 1,
+            'startTimeUnixNano': nanos(record['start']),
+            'endTimeUnixNano': nanos(record['start'] + (record['duration_ms'] or 0) / 1000),
+            'attributes': _otlp_attributes(record['attributes']),
+            'status': {'code': 2 if record['status'] == 'error' else 1}
+        })
+
+    return {
+        'resourceSpans': [{
+            'resource': {'attributes': _otlp_attributes({'service.name': SERVICE_NAME})},
+            'scopeSpans': [{'scope': {'name': 'tracing'}, 'spans': spans}]
+        }]
+    }
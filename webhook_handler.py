@@ -3,11 +3,17 @@ import requests
 import logging
 import time
 import ssl
+from functools import partial
 from google import genai
 from google.genai import types
 import httpx
 from urllib.parse import unquote, quote
 
+import tracing
+import review_archive
+from job_scheduler import scheduler
+from circuit_breaker import UpstreamUnavailable, get_breaker
+
 # Configure logging
 logger = logging.getLogger(__name__)
 
@@ -17,6 +23,32 @@ BITBUCKET_EMAIL = os.environ.get("BITBUCKET_EMAIL")
 BITBUCKET_API_TOKEN = os.environ.get("BITBUCKET_API_TOKEN")
 GEMINI_API_KEY = os.environ.get("GEMINI_API_KEY")
 
+GEMINI_MODEL = "gemini-2.5-flash"
+# Bump whenever the review prompt below changes so archived reviews can be compared
+PROMPT_VERSION = "wp-review-v2"
+# Archived once per version (without the diff), so it deduplicates to a single blob
+REVIEW_PROMPT_TEMPLATE = """
+You are an expert WordPress developer and senior code reviewer.
+Your task is to analyze the following code diff from a pull request.
+
+Please provide feedback on the following aspects:
+1. **Bugs**: Identify any potential logical errors or bugs.
+2. **Performance**: Are there any obvious performance bottlenecks?
+3. **Best Practices**: Suggest improvements based on modern WordPress development best practices.
+
+Format your review clearly using Markdown. If there are no issues, simply state that the code looks good. Try to be concise and keep your response under 2000 characters.
+
+End your review with exactly one of these lines:
+**Security findings:** yes
+**Security findings:** no
+Answer "yes" only if the diff introduces a security vulnerability (e.g. XSS, SQL injection, CSRF, missing sanitization, escaping or nonce checks).
+
+Here is the code diff:
+```diff
+{diff}
+```
+"""
+
 # Initialize Gemini client
 if GEMINI_API_KEY:
     client = genai.Client(api_key=GEMINI_API_KEY)
@@ -24,7 +56,47 @@ else:
     client = None
     logger.warning("GEMINI_API_KEY not set")
 
+bitbucket_breaker = get_breaker('bitbucket')
+gemini_breaker = get_breaker('gemini')
+
+
+def _is_bitbucket_outage(error: requests.exceptions.RequestException) -> bool:
+    """Connection problems, timeouts, 5xx and 429 mean Bitbucket is unavailable"""
+    if isinstance(error, (requests.exceptions.ConnectionError, requests.exceptions.Timeout)):
+        return True
+    status_code = getattr(error.response, 'status_code', None)
+    return status_code is not None and (status_code >= 500 or status_code == 429)
 
+
+def _bitbucket_request(method, url: str, **kwargs):
+    """Make a Bitbucket API request through the circuit breaker"""
+    bitbucket_breaker.check()
+    try:
+        response = requests.request(method, url,
+                                    auth=(BITBUCKET_EMAIL, BITBUCKET_API_TOKEN),
+                                    timeout=30, **kwargs)
+    except requests.exceptions.RequestException as e:
+        bitbucket_breaker.record_failure(e)
+        raise
+    if response.status_code >= 500 or response.status_code == 429:
+        bitbucket_breaker.record_failure(f"HTTP {response.status_code}")
+    else:
+        bitbucket_breaker.record_success()
+    return response
+
+
+def _is_gemini_outage(error: Exception) -> bool:
+    """Network errors, rate limiting and server errors mean Gemini is unavailable"""
+    code = getattr(error, 'code', None)
+    if isinstance(code, int) and (code >= 500 or code == 429):
+        return True
+    error_str = str(error).lower()
+    return any(pattern in error_str for pattern in [
+        'connection', 'timeout', 'network', 'disconnected', 'protocol'
+    ])
+
+
+@tracing.traced('bitbucket.get_pr_diff')
 def get_pr_diff(diff_url: str) -> str:
     """Fetches the diff of a pull request from its diff URL."""
     try:
@@ -36,75 +108,88 @@ def get_pr_diff(diff_url: str) -> str:
             return ""
 
         # Clean up the URL to handle encoding issues
-        logger.info(f"Original diff URL: {diff_url}")
+        logger.debug(f"Original diff URL: {diff_url}")
         
         # First decode any URL encoding, then re-encode properly
         # This handles cases where there are unwanted characters like %0D (carriage return)
-        try:
-            # Decode the URL first
-            decoded_url = unquote(diff_url)
-            logger.info(f"Decoded URL: {decoded_url}")
+        with tracing.span('bitbucket.url_cleanup'):
+            try:
+                # Decode the URL first
+                decoded_url = unquote(diff_url)
+                logger.debug(f"Decoded URL: {decoded_url}")
             
-            # Replace newlines with '..' to form a valid commit range
-            cleaned_url = decoded_url.replace('\r\n', '..').replace('\r', '..').replace('\n', '..').strip()
+                # Replace newlines with '..' to form a valid commit range
+                cleaned_url = decoded_url.replace('\r\n', '..').replace('\r', '..').replace('\n', '..').strip()
             
-            # Re-encode properly if needed (but most of the URL should be fine as-is)
-            # We only need to re-encode the parts after the domain that contain special characters
-            if '/repositories/' in cleaned_url:
-                base_part, path_part = cleaned_url.split('/repositories/', 1)
-                # Split path into URL path and query parameters
-                if '?' in path_part:
-                    url_path, query_params = path_part.split('?', 1)
-                else:
-                    url_path = path_part
-                    query_params = ""
-                
-                # Only re-encode the repository and path parts that contain special characters
-                path_parts = url_path.split('/')
-                encoded_parts = []
-                for part in path_parts:
-                    if ':' in part:
-                        # This is likely a branch/commit reference, encode carefully
-                        encoded_parts.append(quote(part, safe=':'))
+                # Re-encode properly if needed (but most of the URL should be fine as-is)
+                # We only need to re-encode the parts after the domain that contain special characters
+                if '/repositories/' in cleaned_url:
+                    base_part, path_part = cleaned_url.split('/repositories/', 1)
+                    # Split path into URL path and query parameters
+                    if '?' in path_part:
+                        url_path, query_params = path_part.split('?', 1)
                     else:
-                        encoded_parts.append(part)
+                        url_path = path_part
+                        query_params = ""
+                
+                    # Only re-encode the repository and path parts that contain special characters
+                    path_parts = url_path.split('/')
+                    encoded_parts = []
+                    for part in path_parts:
+                        if ':' in part:
+                            # This is likely a branch/commit reference, encode carefully
+                            encoded_parts.append(quote(part, safe=':'))
+                        else:
+                            encoded_parts.append(part)
                 
-                cleaned_url = base_part + '/repositories/' + '/'.join(encoded_parts)
-                if query_params:
-                    cleaned_url += '?' + query_params
+                    cleaned_url = base_part + '/repositories/' + '/'.join(encoded_parts)
+                    if query_params:
+                        cleaned_url += '?' + query_params
             
-            logger.info(f"Cleaned URL: {cleaned_url}")
-            diff_url = cleaned_url
+                logger.debug(f"Cleaned URL: {cleaned_url}")
+                diff_url = cleaned_url
             
-        except Exception as url_error:
-            logger.warning(f"URL cleaning failed, using original: {url_error}")
-            # Fall back to original URL if cleaning fails
-            pass
-
-        logger.info(f"Making authenticated request to: {diff_url}")
-        logger.info(f"Using email: {BITBUCKET_EMAIL}")
+            except Exception as url_error:
+                logger.warning(f"URL cleaning failed, using original: {url_error}")
+                # Fall back to original URL if cleaning fails
+                pass
 
-        response = requests.get(diff_url,
-                                auth=(BITBUCKET_EMAIL, BITBUCKET_API_TOKEN),
-                                timeout=30)
+        logger.debug(f"Making authenticated request to: {diff_url}")
 
-        logger.info(f"Response status: {response.status_code}")
+        with tracing.span('bitbucket.request') as request_span:
+            response = _bitbucket_request('GET', diff_url)
+            if request_span is not None:
+                request_span['attributes']['status_code'] = response.status_code
 
         response.raise_for_status()
-        logger.info(f"Successfully fetched diff from: {diff_url}")
-        logger.info(f"Diff length: {len(response.text)} characters")
+        logger.info(f"Fetched diff ({len(response.text)} characters, status {response.status_code})")
         return response.text
     except requests.exceptions.RequestException as e:
         logger.error(f"Error fetching PR diff: {e}")
         logger.error(
             f"Response status code: {getattr(e.response, 'status_code', 'N/A')}"
         )
-        logger.error(f"Response text: {getattr(e.response, 'text', 'N/A')}")
+        logger.error(f"Response text: {(getattr(e.response, 'text', None) or 'N/A')[:500]}")
+        if _is_bitbucket_outage(e):
+            raise UpstreamUnavailable('bitbucket', f"Bitbucket unavailable while fetching diff: {e}") from e
         return ""
 
 
-def analyze_code_with_gemini(diff: str) -> str:
-    """Sends the code diff to Gemini for analysis with a WordPress-specific prompt."""
+@tracing.traced('gemini.analyze')
+def analyze_code_with_gemini(diff: str, details: dict = None) -> str:
+    """Sends the code diff to Gemini for analysis with a WordPress-specific prompt.
+
+    If ``details`` is given it is filled with the model, prompt template, prompt version,
+    token usage and latency of the call (used by the review archive).
+
+    Raises UpstreamUnavailable when Gemini is down or its circuit breaker is open.
+    """
+    if details is None:
+        details = {}
+    details.update({'model': GEMINI_MODEL, 'prompt_version': PROMPT_VERSION,
+                    'prompt': REVIEW_PROMPT_TEMPLATE})
+    started = time.time()
+
     if not client:
         logger.error("Gemini client not initialized")
         return "Error: Gemini API not configured"
@@ -114,32 +199,30 @@ def analyze_code_with_gemini(diff: str) -> str:
     retry_delay = 2
 
     for attempt in range(max_retries):
+        # Stop retrying as soon as the breaker opens
+        gemini_breaker.check()
         try:
-            prompt = f"""
-You are an expert WordPress developer and senior code reviewer.
-Your task is to analyze the following code diff from a pull request.
-
-Please provide feedback on the following aspects:
-1. **Bugs**: Identify any potential logical errors or bugs.
-2. **Performance**: Are there any obvious performance bottlenecks?
-3. **Best Practices**: Suggest improvements based on modern WordPress development best practices.
-
-Format your review clearly using Markdown. If there are no issues, simply state that the code looks good. Try to be concise and keep your response under 2000 characters.
-
-Here is the code diff:
-```diff
-{diff}
-```
-"""
+            prompt = REVIEW_PROMPT_TEMPLATE.format(diff=diff)
 
             logger.info(
                 f"Attempting Gemini API call (attempt {attempt + 1}/{max_retries})"
             )
 
-            response = client.models.generate_content(model="gemini-2.5-flash",
-                                                      contents=prompt)
+            with tracing.span('gemini.generate_content', attempt=attempt + 1,
+                              diff_chars=len(diff)):
+                response = client.models.generate_content(model=GEMINI_MODEL,
+                                                          contents=prompt)
 
             logger.info(f"Gemini API call successful on attempt {attempt + 1}")
+            gemini_breaker.record_success()
+            usage = getattr(response, 'usage_metadata', None)
+            details.update({
+                'prompt_tokens': getattr(usage, 'prompt_token_count', None),
+                'output_tokens': getattr(usage, 'candidates_token_count', None),
+                'total_tokens': getattr(usage, 'total_token_count', None),
+                'latency_ms': round((time.time() - started) * 1000, 2),
+                'status': 'success'
+            })
             return response.text or "No analysis available"
 
         except (ssl.SSLError, ConnectionError, OSError,
@@ -148,37 +231,41 @@ Here is the code diff:
             logger.warning(
                 f"Network/connection error on attempt {attempt + 1}: {type(e).__name__}: {e}"
             )
+            gemini_breaker.record_failure(e)
             if attempt < max_retries - 1:
                 logger.info(f"Retrying in {retry_delay} seconds...")
-                time.sleep(retry_delay)
+                with tracing.span('gemini.retry_backoff', delay_seconds=retry_delay):
+                    time.sleep(retry_delay)
                 retry_delay *= 2  # Exponential backoff
             else:
                 logger.error("All retry attempts failed for Gemini API")
-                return f"Network connectivity issue with Gemini API after {max_retries} attempts. Connection error: {str(e)}"
+                raise UpstreamUnavailable(
+                    'gemini', f"Network connectivity issue with Gemini API after {max_retries} attempts. Connection error: {str(e)}"
+                ) from e
 
         except Exception as e:
-            # Check if this is any other network-related error that we should retry
+            # Check if this is any other network-related or server error that we should retry
             error_name = type(e).__name__
-            error_str = str(e).lower()
 
-            # Check for common network error patterns
-            if any(pattern in error_str for pattern in [
-                    'connection', 'timeout', 'network', 'disconnected',
-                    'protocol'
-            ]):
+            if _is_gemini_outage(e):
                 logger.warning(
                     f"Potential network error on attempt {attempt + 1}: {error_name}: {e}"
                 )
+                gemini_breaker.record_failure(e)
                 if attempt < max_retries - 1:
                     logger.info(f"Retrying in {retry_delay} seconds...")
-                    time.sleep(retry_delay)
+                    with tracing.span('gemini.retry_backoff', delay_seconds=retry_delay):
+                        time.sleep(retry_delay)
                     retry_delay *= 2  # Exponential backoff
                     continue
                 else:
                     logger.error("All retry attempts failed for Gemini API")
-                    return f"Network connectivity issue with Gemini API after {max_retries} attempts. Error: {str(e)}"
+                    raise UpstreamUnavailable(
+                        'gemini', f"Network connectivity issue with Gemini API after {max_retries} attempts. Error: {str(e)}"
+                    ) from e
 
-            # If we get here, it's a non-retryable error
+            # If we get here, it's a non-retryable error (Gemini itself answered)
+            gemini_breaker.record_success()
             logger.error(f"Non-retryable error calling Gemini API: {e}")
             logger.error(f"Error type: {type(e).__name__}")
             logger.error(f"Diff length: {len(diff)} characters")
@@ -187,26 +274,34 @@ Here is the code diff:
             return f"An error occurred while analyzing the code with Gemini: {str(e)}"
 
 
+@tracing.traced('bitbucket.post_comment')
 def post_comment_to_bitbucket(comments_url: str, comment: str):
-    """Posts a comment to the Bitbucket pull request."""
+    """Posts a comment to the Bitbucket pull request.
+
+    Raises UpstreamUnavailable when Bitbucket is down or its circuit breaker is open.
+    """
     if not BITBUCKET_EMAIL or not BITBUCKET_API_TOKEN:
         logger.error("Bitbucket credentials not configured")
         return
 
     payload = {"content": {"raw": comment}}
     try:
-        response = requests.post(comments_url,
-                                 json=payload,
-                                 auth=(BITBUCKET_EMAIL, BITBUCKET_API_TOKEN),
-                                 timeout=30)
+        response = _bitbucket_request('POST', comments_url, json=payload)
         response.raise_for_status()
         logger.info("Successfully posted comment to Bitbucket.")
     except requests.exceptions.RequestException as e:
         logger.error(f"Error posting comment to Bitbucket: {e}")
+        if _is_bitbucket_outage(e):
+            raise UpstreamUnavailable('bitbucket', f"Bitbucket unavailable while posting comment: {e}") from e
 
 
+@tracing.traced('handle_webhook_payload')
 def handle_webhook_payload(payload: dict):
-    """Main handler for the Bitbucket webhook payload."""
+    """Main handler for the Bitbucket webhook payload.
+
+    Raises UpstreamUnavailable during a Bitbucket or Gemini outage; its
+    ``resume`` continues the job from the stage that failed.
+    """
     try:
         # Check if PR is open
         if payload.get('pullrequest', {}).get('state') != 'OPEN':
@@ -236,28 +331,78 @@ def handle_webhook_payload(payload: dict):
             post_comment_to_bitbucket(comments_url, error_msg)
             return error_msg
 
-        # 2. Analyze with Gemini
-        logger.info(
-            f"Starting Gemini analysis for diff of {len(diff_text)} characters"
-        )
-        review_comment = analyze_code_with_gemini(diff_text)
+        return review_diff(payload, comments_url, diff_text)
 
-        # Check if Gemini analysis failed
-        if review_comment.startswith("An error occurred while analyzing"):
-            logger.error("Gemini analysis failed, check detailed logs above")
-            # Still post the error as a comment for visibility
-            review_comment = f"⚠️ **Code Review Bot Error**\n\n{review_comment}\n\nPlease check the bot logs and try again later."
+    except UpstreamUnavailable:
+        raise
+    except Exception as e:
+        logger.error(f"Error handling webhook payload: {e}")
+        raise
 
-        logger.info(
-            f"Gemini analysis complete, response length: {len(review_comment)} characters"
-        )
 
-        # 3. Post the comment back to Bitbucket
-        post_comment_to_bitbucket(comments_url, review_comment)
+@tracing.traced('review_diff')
+def review_diff(payload: dict, comments_url: str, diff_text: str):
+    """Reviews a fetched diff with Gemini and posts the result."""
+    # 2. Analyze with Gemini
+    logger.info(
+        f"Starting Gemini analysis for diff of {len(diff_text)} characters"
+    )
+    gemini_details = {}
+    try:
+        review_comment = analyze_code_with_gemini(diff_text, gemini_details)
+    except UpstreamUnavailable as e:
+        e.resume = partial(review_diff, payload, comments_url, diff_text)
+        raise
 
-        # Return the analysis for display
-        return review_comment
+    # Same key app.webhook submits the job under
+    repository = payload.get('repository', {}).get('full_name', 'unknown')
+    scheduler.record_token_usage(repository, gemini_details.get('total_tokens'))
 
-    except Exception as e:
-        logger.error(f"Error handling webhook payload: {e}")
+    # Classify on the raw review, then drop the machine-readable marker line
+    # so the PR comment only shows the review itself
+    gemini_details['security_findings'] = review_archive.has_security_findings(review_comment)
+    review_comment = review_archive.strip_security_marker(review_comment)
+
+    # Check if Gemini analysis failed
+    if review_comment.startswith("An error occurred while analyzing"):
+        logger.error("Gemini analysis failed, check detailed logs above")
+        # Still post the error as a comment for visibility
+        review_comment = f"⚠️ **Code Review Bot Error**\n\n{review_comment}\n\nPlease check the bot logs and try again later."
+
+    logger.info(
+        f"Gemini analysis complete, response length: {len(review_comment)} characters"
+    )
+
+    return publish_review(payload, comments_url, diff_text, review_comment, gemini_details)
+
+
+@tracing.traced('publish_review')
+def publish_review(payload: dict, comments_url: str, diff_text: str,
+                   review_comment: str, gemini_details: dict):
+    """Posts a finished review to Bitbucket and archives it."""
+    # 3. Post the comment back to Bitbucket
+    try:
+        post_comment_to_bitbucket(comments_url, review_comment)
+    except UpstreamUnavailable as e:
+        # Keep the review so the replay does not call Gemini again
+        e.resume = partial(publish_review, payload, comments_url, diff_text,
+                           review_comment, gemini_details)
         raise
+
+    # 4. Archive the review (queued, written by a background thread)
+    try:
+        details = dict(gemini_details)
+        review_archive.archive_review(
+            diff=diff_text,
+            review=review_comment,
+            prompt=details.pop('prompt', None),
+            trace_id=tracing.get_trace_id(),
+            status=details.pop('status', 'error'),
+            **details,
+            **review_archive.pr_metadata(payload)
+        )
+    except Exception as e:
+        logger.error(f"Failed to queue review for archiving: {e}")
+
+    # Return the analysis for display
+    return review_comment